@@ -0,0 +1,116 @@
+import functools
+import json
+import os
+import re
+import warnings
+from collections import defaultdict
+
+
+DEFAULT_CACHE_SIZE = 4096
+RULE_CONDITIONS = ('equals', 'matches')
+SCOPED_FLAGS = 'imsx'
+
+_LEADING_FLAGS_PATTERN = re.compile(r'(?:\(\?[a-zA-Z]+\))+')
+
+
+class AttributeMapper:
+    """Maps the attributes of a SAML login to an application username using declarative rules.
+
+    Each rule names an attribute and either the value(s) it must equal or a regular expression one of its values must
+    fully match. The first matching rule, in file order, decides the username. Rules are compiled once: exact rules
+    into a dictionary keyed by (attribute, value), and the patterns for each attribute into one combined regex, so
+    the cost of a decision depends on the number of attribute values, not the number of rules. Decisions are
+    memoized in an LRU cache keyed by the values of the attributes that rules refer to.
+    """
+
+    def __init__(self, rules=(), cache_size=DEFAULT_CACHE_SIZE):
+        self.rules = [self._validate_rule(index, rule) for index, rule in enumerate(rules)]
+        self.attributes = tuple(sorted({rule['attribute'] for rule in self.rules}))
+        self._exact_rules = dict()
+        patterns = defaultdict(list)
+        for index, rule in enumerate(self.rules):
+            if 'equals' in rule:
+                values = rule['equals'] if isinstance(rule['equals'], list) else [rule['equals']]
+                for value in values:
+                    self._exact_rules.setdefault((rule['attribute'], value), index)
+            else:
+                patterns[rule['attribute']].append((index, rule['matches']))
+        self._pattern_rules = {attribute: self._compile_patterns(attribute_patterns)
+                               for attribute, attribute_patterns in patterns.items()}
+        self._decide = functools.lru_cache(maxsize=cache_size)(self._decide_uncached)
+
+    def map(self, attributes):
+        """Return the application username of the first rule that matches the given attributes, or None."""
+        if not self.rules:
+            return None
+        return self._decide(tuple(tuple(attributes.get(attribute, ())) for attribute in self.attributes))
+
+    def cache_info(self):
+        return self._decide.cache_info()
+
+    def _decide_uncached(self, attribute_values):
+        matched = len(self.rules)
+        for attribute, values in zip(self.attributes, attribute_values):
+            pattern_rules = self._pattern_rules.get(attribute)
+            for value in values:
+                matched = min(matched, self._exact_rules.get((attribute, value), matched))
+                if pattern_rules:
+                    combined_pattern, rule_indexes = pattern_rules
+                    match = combined_pattern.fullmatch(value)
+                    if match:
+                        matched = min(matched, rule_indexes[match.lastindex])
+        return self.rules[matched]['user'] if matched < len(self.rules) else None
+
+    @staticmethod
+    def _compile_patterns(attribute_patterns):
+        """Combine patterns into one alternation. Every pattern is wrapped in a group, and the number of that
+        group is mapped back to its rule. The leftmost alternative that fully matches is the earliest rule.
+        """
+        alternatives = []
+        rule_indexes = dict()
+        group = 1
+        for index, pattern in attribute_patterns:
+            rule_indexes[group] = index
+            alternatives.append('(%s)' % AttributeMapper._scope_flags(pattern))
+            group += 1 + re.compile(pattern).groups
+        try:
+            return re.compile('|'.join(alternatives)), rule_indexes
+        except re.error as e:
+            raise Exception('Attribute mapping patterns cannot be combined (named groups must be unique): %s' % e)
+
+    @staticmethod
+    def _scope_flags(pattern):
+        """Turn leading inline flags, e.g. (?i), into a group so that they only apply to this rule's pattern."""
+        match = _LEADING_FLAGS_PATTERN.match(pattern)
+        if not match:
+            return pattern
+        flags = ''.join(re.findall('[a-zA-Z]', match.group(0)))
+        # A newline ends a trailing comment in a verbose (x) pattern before the group is closed.
+        return '(?%s:%s%s)' % (flags, pattern[match.end():], '\n' if 'x' in flags else '')
+
+    @staticmethod
+    def _validate_rule(index, rule):
+        if not isinstance(rule, dict) or not rule.get('attribute') or not rule.get('user'):
+            raise Exception('Attribute mapping rule %d must have an "attribute" and a "user"' % index)
+        if sum(condition in rule for condition in RULE_CONDITIONS) != 1:
+            raise Exception('Attribute mapping rule %d must have exactly one of: %s' % (index, ', '.join(RULE_CONDITIONS)))
+        if 'matches' in rule:
+            match = _LEADING_FLAGS_PATTERN.match(rule['matches'])
+            if match and set(re.findall('[a-zA-Z]', match.group(0))) - set(SCOPED_FLAGS):
+                raise Exception('Attribute mapping rule %d may only use these inline flags: %s' % (index, ', '.join(SCOPED_FLAGS)))
+            try:
+                # Inline flags after the start of a pattern are deprecated before Python 3.11 and an error since.
+                with warnings.catch_warnings():
+                    warnings.simplefilter('error', DeprecationWarning)
+                    re.compile(rule['matches'])
+            except (re.error, DeprecationWarning) as e:
+                raise Exception('Attribute mapping rule %d has an invalid pattern: %s' % (index, e))
+        return rule
+
+
+def load_attribute_mapper(path, cache_size=DEFAULT_CACHE_SIZE):
+    """Compile the attribute mapping rules file at the given path. Without a rules file, no attributes are mapped."""
+    if not os.path.exists(path):
+        return AttributeMapper(cache_size=cache_size)
+    with open(path, 'rb') as rules_file:
+        return AttributeMapper(json.load(rules_file).get('rules', []), cache_size=cache_size)
@@ -0,0 +1,70 @@
+import asyncio
+import glob
+import logging
+import os
+import time
+
+
+DEFAULT_RELOAD_INTERVAL = 10
+
+
+class SamlConfigWatcher:
+    """Polls the SAML configuration files and runs a reload callback when any of them is added, changed or removed.
+
+    Polling a handful of os.stat calls every few seconds keeps the watcher free of platform-specific file
+    notification dependencies. The reload callback may return a time at which it must run again even if no file
+    has changed (e.g. when a certificate overlap window ends).
+    """
+
+    def __init__(self, patterns, reload, interval=DEFAULT_RELOAD_INTERVAL, log=None):
+        self.patterns = patterns
+        self.reload = reload
+        self.interval = interval
+        self.log = log or logging.getLogger('saml_config_watcher')
+        self.reload_at = None
+        self._file_states = self._get_file_states()
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self):
+        if self.interval and not self._task:
+            self._task = asyncio.ensure_future(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def has_changed(self):
+        """Return True if the watched files changed since the last call, or a requested reload time has passed."""
+        file_states = self._get_file_states()
+        changed = file_states != self._file_states
+        self._file_states = file_states
+        return changed or bool(self.reload_at and self.reload_at <= time.time())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if self.has_changed():
+                    self.reload_at = await self.reload()
+            except Exception as e:
+                self.log.error('Failed to reload SAML settings: %s', e)
+
+    def _get_file_states(self):
+        file_states = dict()
+        for pattern in self.patterns:
+            for path in glob.glob(pattern):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                file_states[path] = (stat.st_mtime_ns, stat.st_size)
+        return file_states
@@ -0,0 +1,68 @@
+DEFAULT_IDP = 'default'
+PLUGIN_SETTINGS_KEYS = ('hosts', 'metadata')
+
+
+class IdpRegistry:
+    """Immutable index of the precompiled settings for every configured identity provider.
+
+    The IdP configured in conf/settings.json is named "default"; if it is absent and only one IdP is configured,
+    that IdP is the default. Incoming responses are routed by their Issuer and login redirects by IdP name or
+    request host, each with a single dictionary lookup. Changes produce a new registry (see with_idp) so that
+    it can be swapped in atomically while in-flight requests keep using the registry they started with.
+    """
+
+    def __init__(self, idps=None):
+        self._by_name = dict(idps or {})
+        self._by_issuer = dict()
+        self._by_host = dict()
+        for name, (snapshot, hosts) in self._by_name.items():
+            if snapshot.idp_entity_id in self._by_issuer:
+                raise Exception('Identity providers "%s" and "%s" share the issuer %s' %
+                                (self._by_issuer[snapshot.idp_entity_id][0], name, snapshot.idp_entity_id))
+            self._by_issuer[snapshot.idp_entity_id] = (name, snapshot)
+            for host in hosts:
+                self._by_host[host.lower()] = snapshot
+        if DEFAULT_IDP in self._by_name:
+            self.default_idp = DEFAULT_IDP
+        elif len(self._by_name) == 1:
+            self.default_idp = next(iter(self._by_name))
+        else:
+            self.default_idp = None
+
+    @property
+    def names(self):
+        return list(self._by_name)
+
+    @property
+    def default(self):
+        return self._by_name[self.default_idp][0] if self.default_idp else None
+
+    def with_idp(self, name, snapshot, hosts=()):
+        """Return a copy of this registry with the given IdP added or replaced."""
+        idps = dict(self._by_name)
+        idps[name] = (snapshot, tuple(hosts))
+        return IdpRegistry(idps)
+
+    def get(self, name):
+        entry = self._by_name.get(name)
+        return entry[0] if entry else None
+
+    def get_hosts(self, name):
+        entry = self._by_name.get(name)
+        return entry[1] if entry else ()
+
+    def for_issuer(self, issuer):
+        """Return the settings for the IdP that issued a response, falling back to the default IdP."""
+        entry = self._by_issuer.get(issuer)
+        return entry[1] if entry else self.default
+
+    def for_login(self, idp_name=None, host=None):
+        """Return the settings to use for a login redirect, selected by IdP name, then host, then default."""
+        return self.get(idp_name) or self._by_host.get((host or '').lower()) or self.default
+
+
+def split_plugin_settings(config):
+    """Separate the plugin's own keys (e.g. "hosts" and "metadata") from the python3-saml settings in an IdP config file."""
+    saml_config = {key: value for key, value in config.items() if key not in PLUGIN_SETTINGS_KEYS}
+    plugin_config = {key: config[key] for key in PLUGIN_SETTINGS_KEYS if key in config}
+    return saml_config, plugin_config
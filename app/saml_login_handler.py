@@ -4,6 +4,7 @@ from aiohttp import web
 from app.service.interfaces.i_login_handler import LoginHandlerInterface
 
 HANDLER_NAME = 'SAML Login Handler'
+IDP_QUERY_PARAMETER = 'idp'
 
 
 def load_login_handler(services):
@@ -34,10 +35,10 @@ class SamlLoginHandler(LoginHandlerInterface):
             return await auth_svc.default_login_handler.handle_login(request, kwargs=kwargs)
 
     async def handle_login_redirect(self, request, **kwargs):
-        """Will raise web.HTTPFound for identity provider redirect on success."""
+        """Will raise web.HTTPFound for identity provider redirect on success. The identity provider is chosen by
+        the "idp" query parameter if present, otherwise by the host the request was sent to.
+        """
         saml_svc = self.services.get('saml_svc', None)
         if not saml_svc:
             raise Exception('SAML service not found.')
-        auth = await saml_svc.get_saml_auth(request)
-        redirect = auth.login()
-        raise web.HTTPFound(redirect)
+        raise web.HTTPFound(await saml_svc.get_login_redirect(request, idp_name=request.query.get(IDP_QUERY_PARAMETER)))
@@ -0,0 +1,171 @@
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+import warnings
+warnings.filterwarnings('ignore', 'defusedxml.lxml is no longer supported and will be removed in a future release.', DeprecationWarning)
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+
+
+DEFAULT_REFRESH_INTERVAL = 3600
+MIN_REFRESH_INTERVAL = 60
+RETRY_INTERVAL = 300
+FETCH_TIMEOUT = 10
+REMOTE_SCHEMES = ('http', 'https')
+INSECURE_SCHEME = 'http'
+
+IdpMetadata = namedtuple('IdpMetadata', [
+    'location',
+    'idp',
+    'valid_until',
+    'cache_duration',
+    'fetched_at',
+    'etag',
+    'last_modified',
+])
+
+
+def is_remote_metadata(location):
+    return urlsplit(location).scheme in REMOTE_SCHEMES
+
+
+def is_insecure_metadata(location):
+    return urlsplit(location).scheme == INSECURE_SCHEME
+
+
+class IdpMetadataSource:
+    """IdP metadata read from a file path or URL and kept in memory in its parsed form.
+
+    The parsed "idp" settings are cached on disk together with the document's validUntil and cacheDuration and the
+    HTTP validators, so that a restarted server can use them without fetching anything. Only refresh() performs
+    network or metadata file I/O; it is meant to run on a worker thread and uses conditional requests, so an
+    unchanged document is neither downloaded nor parsed again.
+
+    The metadata replaces the IdP's signing certificate, so it is only fetched over plain http if allow_http is set.
+    If a cert_fingerprint is given, metadata whose signing certificates do not all match it is rejected.
+    """
+
+    def __init__(self, location, cache_path, entity_id=None, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 allow_http=False, cert_fingerprint=None, cert_fingerprint_algorithm='sha1'):
+        if is_insecure_metadata(location) and not allow_http:
+            raise Exception('Refusing to fetch IdP metadata over plain http from %s' % location)
+        self.location = location
+        self.cache_path = cache_path
+        self.entity_id = entity_id
+        self.refresh_interval = refresh_interval
+        self.cert_fingerprint = cert_fingerprint
+        self.cert_fingerprint_algorithm = cert_fingerprint_algorithm
+        self.metadata = self._load_cache()
+        self.next_refresh = self._get_next_refresh(self.metadata) if self.metadata else 0
+
+    def merge_into(self, saml_config):
+        """Return a copy of the given settings with the IdP settings from the metadata applied on top."""
+        if not self.metadata:
+            raise Exception('IdP metadata from %s has not been fetched yet' % self.location)
+        return OneLogin_Saml2_IdPMetadataParser.merge_settings(saml_config, dict(idp=self.metadata.idp))
+
+    def is_expired(self):
+        return bool(self.metadata and self.metadata.valid_until and self.metadata.valid_until < time.time())
+
+    def refresh(self):
+        """Fetch the metadata if it changed since the last fetch, then update the in-memory and on-disk copies.
+        Returns True if the parsed IdP settings changed.
+        """
+        now = time.time()
+        self.next_refresh = now + RETRY_INTERVAL
+        document, etag, last_modified = self._fetch()
+        if document is None:
+            metadata = self.metadata._replace(fetched_at=now)
+        else:
+            metadata = self._parse(document, now, etag, last_modified)
+        changed = not self.metadata or metadata.idp != self.metadata.idp
+        self.metadata = metadata
+        self._save_cache(metadata)
+        self.next_refresh = self._get_next_refresh(metadata)
+        return changed
+
+    def _fetch(self):
+        """Return the metadata document and its validators, or None as the document if it has not changed."""
+        previous = self.metadata
+        if not is_remote_metadata(self.location):
+            last_modified = str(os.stat(self.location).st_mtime_ns)
+            if previous and previous.last_modified == last_modified:
+                return None, None, last_modified
+            with open(self.location, 'rb') as metadata_file:
+                return metadata_file.read(), None, last_modified
+        request = urllib.request.Request(self.location)
+        if previous and previous.etag:
+            request.add_header('If-None-Match', previous.etag)
+        if previous and previous.last_modified:
+            request.add_header('If-Modified-Since', previous.last_modified)
+        try:
+            with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:  # nosec - only http(s) URLs get here
+                return response.read(), response.headers.get('ETag'), response.headers.get('Last-Modified')
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and previous:
+                return None, previous.etag, previous.last_modified
+            raise
+
+    def _parse(self, document, fetched_at, etag, last_modified):
+        root = OneLogin_Saml2_XML.to_etree(document)
+        idp = OneLogin_Saml2_IdPMetadataParser.parse(root, entity_id=self.entity_id).get('idp')
+        if not idp or not idp.get('entityId'):
+            raise Exception('No IdP EntityDescriptor found in metadata from %s' % self.location)
+        self._check_cert_fingerprint(idp)
+        valid_until = root.get('validUntil')
+        return IdpMetadata(
+            location=self.location,
+            idp=idp,
+            valid_until=OneLogin_Saml2_Utils.parse_SAML_to_time(valid_until) if valid_until else None,
+            cache_duration=root.get('cacheDuration'),
+            fetched_at=fetched_at,
+            etag=etag,
+            last_modified=last_modified,
+        )
+
+    def _check_cert_fingerprint(self, idp):
+        if not self.cert_fingerprint:
+            return
+        pinned_fingerprint = OneLogin_Saml2_Utils.format_finger_print(self.cert_fingerprint)
+        signing_certs = idp.get('x509certMulti', dict()).get('signing') or [idp.get('x509cert')]
+        for cert in signing_certs:
+            fingerprint = OneLogin_Saml2_Utils.calculate_x509_fingerprint(OneLogin_Saml2_Utils.format_cert(cert or ''),
+                                                                          self.cert_fingerprint_algorithm)
+            if fingerprint != pinned_fingerprint:
+                raise Exception('IdP signing certificate in metadata from %s does not match the pinned certFingerprint' %
+                                self.location)
+
+    def _get_next_refresh(self, metadata):
+        if not is_remote_metadata(self.location):
+            # Checking a local file is a single os.stat, so it is done on every pass.
+            return 0
+        deadlines = [metadata.fetched_at + self.refresh_interval]
+        if metadata.cache_duration:
+            deadlines.append(OneLogin_Saml2_Utils.parse_duration(metadata.cache_duration, int(metadata.fetched_at)))
+        if metadata.valid_until:
+            deadlines.append(metadata.valid_until)
+        return max(min(deadlines), metadata.fetched_at + MIN_REFRESH_INTERVAL)
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                metadata = IdpMetadata(**json.load(cache_file))
+            if metadata.location != self.location:
+                return None
+            self._check_cert_fingerprint(metadata.idp)
+        except Exception:
+            return None
+        return metadata
+
+    def _save_cache(self, metadata):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        temp_path = '%s.tmp' % self.cache_path
+        with open(temp_path, 'w') as cache_file:
+            json.dump(metadata._asdict(), cache_file)
+        os.replace(temp_path, self.cache_path)
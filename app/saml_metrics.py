@@ -0,0 +1,98 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+
+STAGE_FORM_PARSE = 'form_parse'
+STAGE_AUTH_CONSTRUCTION = 'auth_construction'
+STAGE_VERIFICATION_WAIT = 'verification_wait'
+STAGE_PROCESS_RESPONSE = 'process_response'
+STAGE_ATTRIBUTE_EXTRACTION = 'attribute_extraction'
+STAGE_USER_LOOKUP = 'user_lookup'
+STAGE_SUCCESSFUL_LOGIN = 'successful_login'
+STAGE_LOGIN_REDIRECT = 'login_redirect'
+STAGES = (STAGE_FORM_PARSE, STAGE_AUTH_CONSTRUCTION, STAGE_VERIFICATION_WAIT, STAGE_PROCESS_RESPONSE,
+          STAGE_ATTRIBUTE_EXTRACTION, STAGE_USER_LOOKUP, STAGE_SUCCESSFUL_LOGIN, STAGE_LOGIN_REDIRECT)
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_UNKNOWN_USER = 'unknown_user'
+OUTCOME_SIGNATURE_ERROR = 'signature_error'
+OUTCOME_INVALID_RESPONSE = 'invalid_response'
+OUTCOME_MISSING_USERNAME = 'missing_username_attribute'
+OUTCOME_REPLAY = 'replay'
+OUTCOME_REJECTED = 'rejected'
+OUTCOME_ERROR = 'error'
+OUTCOMES = (OUTCOME_SUCCESS, OUTCOME_UNKNOWN_USER, OUTCOME_SIGNATURE_ERROR, OUTCOME_INVALID_RESPONSE,
+            OUTCOME_MISSING_USERNAME, OUTCOME_REPLAY, OUTCOME_REJECTED, OUTCOME_ERROR)
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class SamlLoginRejected(Exception):
+    """Raised when a SAML login is refused, recording why for the outcome counters."""
+
+    def __init__(self, outcome, message):
+        super().__init__(message)
+        self.outcome = outcome
+
+
+class Histogram:
+    """Cumulative latency histogram in the Prometheus style. Observing is a bisect plus two additions."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class SamlMetrics:
+    """Per-stage latency histograms and outcome counters for the SAML login path."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.stage_latency = {stage: Histogram(buckets) for stage in STAGES}
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+
+    @contextmanager
+    def time_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_latency[stage].observe(time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        self.stage_latency[stage].observe(seconds)
+
+    def count_outcome(self, outcome):
+        self.outcomes[outcome] += 1
+
+    def render_prometheus(self):
+        lines = [
+            '# HELP saml_stage_duration_seconds Time spent in each stage of the SAML login path.',
+            '# TYPE saml_stage_duration_seconds histogram',
+        ]
+        for stage, histogram in self.stage_latency.items():
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.cumulative_counts()):
+                lines.append('saml_stage_duration_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, count))
+            lines.append('saml_stage_duration_seconds_sum{stage="%s"} %.9f' % (stage, histogram.sum))
+            lines.append('saml_stage_duration_seconds_count{stage="%s"} %d' % (stage, histogram.count))
+        lines.extend([
+            '# HELP saml_login_outcomes_total SAML login attempts by outcome.',
+            '# TYPE saml_login_outcomes_total counter',
+        ])
+        for outcome, count in self.outcomes.items():
+            lines.append('saml_login_outcomes_total{outcome="%s"} %d' % (outcome, count))
+        return '\n'.join(lines) + '\n'
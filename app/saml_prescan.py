@@ -0,0 +1,62 @@
+import base64
+import binascii
+import html
+import re
+from collections import namedtuple
+
+from plugins.saml.app.saml_metrics import OUTCOME_REJECTED, SamlLoginRejected
+
+
+SamlPrescan = namedtuple('SamlPrescan', [
+    'response_id',
+    'assertion_ids',
+    'issuer',
+    'destination',
+    'in_response_to',
+    'has_signature',
+    'has_encrypted_assertion',
+])
+
+_RESPONSE_TAG_PATTERN = re.compile(rb'<(?:[\w.-]+:)?Response\b([^>]*)>')
+_ASSERTION_TAG_PATTERN = re.compile(rb'<(?:[\w.-]+:)?Assertion\b([^>]*)>')
+_ATTRIBUTE_PATTERN = re.compile(rb'\s([\w:.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_ISSUER_PATTERN = re.compile(rb'<(?:[\w.-]+:)?Issuer\b[^>]*>\s*([^<]*?)\s*<')
+_SIGNATURE_PATTERN = re.compile(rb'<(?:[\w.-]+:)?Signature\b')
+_ENCRYPTED_ASSERTION_PATTERN = re.compile(rb'<(?:[\w.-]+:)?EncryptedAssertion\b')
+
+
+def prescan_saml_response(saml_response_b64):
+    """Cheaply extract identifying values from an unverified SAML response using a regex scan of the
+    decoded document, without building an XML tree or touching xmlsec. Values returned here are untrusted
+    and must only be used to reject requests early, never to accept them.
+    """
+    try:
+        document = base64.b64decode(saml_response_b64)
+    except (binascii.Error, ValueError):
+        raise SamlLoginRejected(OUTCOME_REJECTED, 'SAML response is not valid base64')
+    response_tag = _RESPONSE_TAG_PATTERN.search(document)
+    if not response_tag:
+        raise SamlLoginRejected(OUTCOME_REJECTED, 'SAML response does not contain a Response element')
+    response_attributes = _parse_attributes(response_tag.group(1))
+    issuer = _ISSUER_PATTERN.search(document, response_tag.end())
+    return SamlPrescan(
+        response_id=response_attributes.get('ID'),
+        assertion_ids=[_parse_attributes(attributes).get('ID')
+                       for attributes in _ASSERTION_TAG_PATTERN.findall(document, response_tag.end())],
+        issuer=_decode(issuer.group(1)) if issuer else None,
+        destination=response_attributes.get('Destination'),
+        in_response_to=response_attributes.get('InResponseTo'),
+        has_signature=bool(_SIGNATURE_PATTERN.search(document, response_tag.end())),
+        has_encrypted_assertion=bool(_ENCRYPTED_ASSERTION_PATTERN.search(document, response_tag.end())),
+    )
+
+
+def _parse_attributes(tag_contents):
+    attributes = dict()
+    for name, double_quoted, single_quoted in _ATTRIBUTE_PATTERN.findall(tag_contents):
+        attributes[_decode(name)] = _decode(double_quoted or single_quoted)
+    return attributes
+
+
+def _decode(value):
+    return html.unescape(value.decode('utf-8', 'replace'))
@@ -0,0 +1,171 @@
+import asyncio
+import re
+import time
+import warnings
+warnings.filterwarnings('ignore', 'defusedxml.lxml is no longer supported and will be removed in a future release.', DeprecationWarning)
+from collections import OrderedDict, deque
+
+import xmlsec
+from onelogin.saml2.authn_request import OneLogin_Saml2_Authn_Request
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_MAX_AGE = 60
+DEFAULT_ISSUED_TTL = 900
+DEFAULT_MAX_ISSUED = 10000
+
+SIGN_ALGORITHM_TRANSFORMS = {
+    OneLogin_Saml2_Constants.DSA_SHA1: xmlsec.Transform.DSA_SHA1,
+    OneLogin_Saml2_Constants.RSA_SHA1: xmlsec.Transform.RSA_SHA1,
+    OneLogin_Saml2_Constants.RSA_SHA256: xmlsec.Transform.RSA_SHA256,
+    OneLogin_Saml2_Constants.RSA_SHA384: xmlsec.Transform.RSA_SHA384,
+    OneLogin_Saml2_Constants.RSA_SHA512: xmlsec.Transform.RSA_SHA512,
+}
+
+_ISSUE_INSTANT_PATTERN = re.compile(r'IssueInstant="([^"]+)"')
+
+
+class IssuedRequestIndex:
+    """Bounded index of the AuthnRequest IDs sent to identity providers, used to validate the InResponseTo of
+    returning responses. Entries are consumed on use, expire after a TTL and the oldest are dropped first.
+    """
+
+    def __init__(self, ttl=DEFAULT_ISSUED_TTL, max_entries=DEFAULT_MAX_ISSUED):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._expiries = OrderedDict()
+
+    def add(self, request_id):
+        now = time.time()
+        self._evict(now)
+        self._expiries[request_id] = now + self.ttl
+        while len(self._expiries) > self.max_entries:
+            self._expiries.popitem(last=False)
+
+    def contains(self, request_id):
+        """Return True if the ID was issued, has not expired and has not been consumed."""
+        expiry = self._expiries.get(request_id)
+        return expiry is not None and expiry > time.time()
+
+    def consume(self, request_id):
+        """Return True, and forget the ID, if it was issued and has not expired."""
+        expiry = self._expiries.pop(request_id, None)
+        return expiry is not None and expiry > time.time()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def _evict(self, now):
+        while self._expiries:
+            request_id, expiry = next(iter(self._expiries.items()))
+            if expiry > now:
+                break
+            del self._expiries[request_id]
+
+
+class AuthnRequestPool:
+    """Pre-generated, deflated and encoded AuthnRequests for one identity provider.
+
+    The AuthnRequest XML is rendered once from the precompiled settings and reduced to a template in which only
+    the ID and IssueInstant vary. A small pool of encoded requests is kept ready and refilled in the background,
+    so the login redirect only has to pop a request, add the RelayState and (if required) sign the query string.
+    """
+
+    def __init__(self, settings_snapshot, pool_size=DEFAULT_POOL_SIZE, max_age=DEFAULT_MAX_AGE):
+        self.settings_snapshot = settings_snapshot
+        self.pool_size = pool_size
+        self.max_age = max_age
+        self._template = self._build_template(settings_snapshot.settings)
+        self._pool = deque()
+        self._refill_task = None
+        security = settings_snapshot.settings.get_security_data()
+        self._sign_algorithm = security['signatureAlgorithm'] if security.get('authnRequestsSigned') else None
+        if self._sign_algorithm and not settings_snapshot.sp_key:
+            raise Exception('authnRequestsSigned is enabled but no SP private key is configured')
+
+    def build_redirect(self, request_data):
+        """Return the request ID and IdP redirect URL for a login request."""
+        request_id, saml_request = self._take()
+        parameters = dict(SAMLRequest=saml_request, RelayState=OneLogin_Saml2_Utils.get_self_url_no_query(request_data))
+        if self._sign_algorithm:
+            parameters['SigAlg'] = self._sign_algorithm
+            parameters['Signature'] = self._sign(parameters)
+        redirect = OneLogin_Saml2_Utils.redirect(self.settings_snapshot.settings.get_idp_sso_url(), parameters,
+                                                 request_data)
+        return request_id, redirect
+
+    def fill(self):
+        while len(self._pool) < self.pool_size:
+            self._pool.append(self._generate())
+
+    def _take(self):
+        oldest_allowed = time.time() - self.max_age
+        while self._pool:
+            request_id, saml_request, created = self._pool.popleft()
+            if created >= oldest_allowed:
+                break
+        else:
+            request_id, saml_request, created = self._generate()
+        if len(self._pool) <= self.pool_size // 2:
+            self._schedule_refill()
+        return request_id, saml_request
+
+    def _generate(self):
+        request_id = OneLogin_Saml2_Utils.generate_unique_id()
+        xml = self._template % dict(id=request_id,
+                                    issue_instant=OneLogin_Saml2_Utils.parse_time_to_SAML(OneLogin_Saml2_Utils.now()))
+        return request_id, OneLogin_Saml2_Utils.deflate_and_base64_encode(xml), time.time()
+
+    def _schedule_refill(self):
+        if not self._refill_task or self._refill_task.done():
+            try:
+                self._refill_task = asyncio.ensure_future(self._refill())
+            except RuntimeError:
+                self.fill()
+
+    async def _refill(self):
+        while len(self._pool) < self.pool_size:
+            self._pool.append(self._generate())
+            await asyncio.sleep(0)
+
+    def _sign(self, parameters):
+        sign_query = '&'.join('%s=%s' % (name, OneLogin_Saml2_Utils.escape_url(parameters[name]))
+                              for name in ('SAMLRequest', 'RelayState', 'SigAlg'))
+        sign_ctx = xmlsec.SignatureContext()
+        sign_ctx.key = self.settings_snapshot.sp_key
+        transform = SIGN_ALGORITHM_TRANSFORMS.get(self._sign_algorithm, xmlsec.Transform.RSA_SHA1)
+        return OneLogin_Saml2_Utils.b64encode(sign_ctx.sign_binary(sign_query.encode('utf-8'), transform))
+
+    @staticmethod
+    def _build_template(settings):
+        authn_request = OneLogin_Saml2_Authn_Request(settings)
+        xml = authn_request.get_xml()
+        issue_instant = _ISSUE_INSTANT_PATTERN.search(xml).group(1)
+        return xml.replace('%', '%%') \
+            .replace('ID="%s"' % authn_request.get_id(), 'ID="%(id)s"', 1) \
+            .replace('IssueInstant="%s"' % issue_instant, 'IssueInstant="%(issue_instant)s"', 1)
+
+
+class SamlRedirectEngine:
+    """Builds login redirects from per-IdP AuthnRequest pools and records the issued request IDs."""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_age=DEFAULT_MAX_AGE, issued_ttl=DEFAULT_ISSUED_TTL,
+                 max_issued=DEFAULT_MAX_ISSUED):
+        self.pool_size = pool_size
+        self.max_age = max_age
+        self.issued_requests = IssuedRequestIndex(issued_ttl, max_issued)
+        self._pools = dict()
+
+    def build_redirect(self, settings_snapshot, request_data):
+        request_id, redirect = self.get_pool(settings_snapshot).build_redirect(request_data)
+        self.issued_requests.add(request_id)
+        return redirect
+
+    def get_pool(self, settings_snapshot):
+        pool = self._pools.get(settings_snapshot.idp_entity_id)
+        if not pool or pool.settings_snapshot is not settings_snapshot:
+            pool = AuthnRequestPool(settings_snapshot, self.pool_size, self.max_age)
+            self._pools[settings_snapshot.idp_entity_id] = pool
+        return pool
@@ -0,0 +1,138 @@
+import heapq
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MIN_TTL = 300
+CLOCK_DRIFT = 300
+
+
+class MemoryReplayBackend:
+    """Process-local index of accepted SAML message IDs. Lookups are dictionary hits; a min-heap ordered by
+    expiry time lets expired entries, or the soonest-expiring ones once the entry cap is hit, be evicted
+    without scanning the index.
+    """
+
+    blocking = False
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._expiries = dict()
+        self._heap = []
+
+    def contains(self, message_id, now):
+        expiry = self._expiries.get(message_id)
+        return expiry is not None and expiry > now
+
+    def add(self, message_ids, expiry, now):
+        self._evict(now)
+        if any(message_id in self._expiries for message_id in message_ids):
+            return False
+        for message_id in message_ids:
+            self._expiries[message_id] = expiry
+            heapq.heappush(self._heap, (expiry, message_id))
+        while len(self._expiries) > self.max_entries:
+            self._pop_soonest()
+        return True
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def _evict(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            self._pop_soonest()
+
+    def _pop_soonest(self):
+        expiry, message_id = heapq.heappop(self._heap)
+        if self._expiries.get(message_id) == expiry:
+            del self._expiries[message_id]
+
+
+class SqliteReplayBackend:
+    """Replay index stored in a SQLite database file so that several CALDERA servers sharing a filesystem
+    (e.g. workers behind a load balancer) reject each other's replayed responses. Calls may wait up to the lock
+    timeout for another server's write transaction, so they must not be made on the event loop.
+    """
+
+    blocking = True
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS saml_replay (message_id TEXT PRIMARY KEY, expiry REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS saml_replay_expiry ON saml_replay (expiry)')
+
+    def contains(self, message_id, now):
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM saml_replay WHERE message_id = ? AND expiry > ?',
+                                     (message_id, now)).fetchone()
+        return row is not None
+
+    def add(self, message_ids, expiry, now):
+        # The connection is shared by worker threads, and a transaction must not interleave with another thread's.
+        with self._lock:
+            return self._add(message_ids, expiry, now)
+
+    def _add(self, message_ids, expiry, now):
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._conn.execute('DELETE FROM saml_replay WHERE expiry <= ?', (now,))
+            self._conn.executemany('INSERT INTO saml_replay (message_id, expiry) VALUES (?, ?)',
+                                   [(message_id, expiry) for message_id in message_ids])
+            self._conn.execute('DELETE FROM saml_replay WHERE message_id IN (SELECT message_id FROM saml_replay '
+                               'ORDER BY expiry LIMIT max(0, (SELECT count(*) FROM saml_replay) - ?))',
+                               (self.max_entries,))
+        except sqlite3.IntegrityError:
+            self._conn.execute('ROLLBACK')
+            return False
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return True
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT count(*) FROM saml_replay').fetchone()[0]
+
+
+class AssertionReplayCache:
+    """Remembers the Response and Assertion IDs of accepted SAML responses until they expire, so that
+    double-submitted or replayed responses can be rejected before any signature verification. If the backend is
+    blocking, is_replay() and record() should be run on a worker thread.
+    """
+
+    def __init__(self, backend, min_ttl=DEFAULT_MIN_TTL):
+        self.backend = backend
+        self.min_ttl = min_ttl
+
+    @property
+    def blocking(self):
+        return self.backend.blocking
+
+    def is_replay(self, message_ids):
+        now = time.time()
+        return any(self.backend.contains(message_id, now) for message_id in message_ids if message_id)
+
+    def record(self, message_ids, not_on_or_after=None):
+        """Record the IDs of an accepted response. Returns False if any of them was already recorded."""
+        message_ids = [message_id for message_id in message_ids if message_id]
+        if not message_ids:
+            return True
+        now = time.time()
+        expiry = max((not_on_or_after or 0) + CLOCK_DRIFT, now + self.min_ttl)
+        return self.backend.add(message_ids, expiry, now)
+
+
+def create_replay_cache(backend='memory', path=None, max_entries=DEFAULT_MAX_ENTRIES, min_ttl=DEFAULT_MIN_TTL):
+    if backend == 'memory':
+        return AssertionReplayCache(MemoryReplayBackend(max_entries), min_ttl)
+    if backend == 'sqlite':
+        if not path:
+            raise Exception('A path is required for the sqlite SAML replay cache backend')
+        return AssertionReplayCache(SqliteReplayBackend(path, max_entries), min_ttl)
+    raise Exception('Unsupported SAML replay cache backend: %s' % backend)
@@ -0,0 +1,36 @@
+from urllib.parse import parse_qsl
+
+from multidict import MultiDict
+
+from plugins.saml.app.saml_metrics import OUTCOME_REJECTED, SamlLoginRejected
+
+
+FORM_KEY = 'saml_form'
+DEFAULT_MAX_BODY_SIZE = 256 * 1024
+CHUNK_SIZE = 16 * 1024
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+
+async def read_form(request, max_body_size=DEFAULT_MAX_BODY_SIZE):
+    """Return the request's form data, parsing it at most once per request. The body is streamed and
+    abandoned as soon as it exceeds max_body_size, so oversized payloads are rejected before they are
+    buffered, decoded or parsed.
+    """
+    form = request.get(FORM_KEY)
+    if form is None:
+        form = await _stream_form(request, max_body_size)
+        request[FORM_KEY] = form
+    return form
+
+
+async def _stream_form(request, max_body_size):
+    if not request.body_exists or request.content_type != FORM_CONTENT_TYPE:
+        return MultiDict()
+    if request.content_length is not None and request.content_length > max_body_size:
+        raise SamlLoginRejected(OUTCOME_REJECTED, 'SAML request body of %d bytes exceeds the %d byte limit' % (request.content_length, max_body_size))
+    body = bytearray()
+    async for chunk in request.content.iter_chunked(CHUNK_SIZE):
+        body.extend(chunk)
+        if len(body) > max_body_size:
+            raise SamlLoginRejected(OUTCOME_REJECTED, 'SAML request body exceeds the %d byte limit' % max_body_size)
+    return MultiDict(parse_qsl(body.decode(request.charset or 'utf-8'), keep_blank_values=True))
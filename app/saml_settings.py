@@ -0,0 +1,62 @@
+import copy
+import hashlib
+import json
+import warnings
+warnings.filterwarnings('ignore', 'defusedxml.lxml is no longer supported and will be removed in a future release.', DeprecationWarning)
+
+import xmlsec
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+
+
+MAX_COMPILED_SNAPSHOTS = 32
+
+_compiled_snapshots = dict()
+
+
+class SamlSettingsSnapshot:
+    """Validated, precompiled python3-saml settings that can be shared across requests.
+
+    Building OneLogin_Saml2_Settings validates the whole settings tree and reformats the certificates, so
+    it is done once here instead of on every request. The snapshot is immutable once built; configuration
+    changes are applied by building a new snapshot and swapping it in.
+    """
+
+    def __init__(self, config):
+        self.config = copy.deepcopy(config)
+        self.fingerprint = hashlib.sha256(json.dumps(self.config, sort_keys=True).encode('utf-8')).hexdigest()
+        self.settings = OneLogin_Saml2_Settings(copy.deepcopy(self.config))
+        self.idp_entity_id = self.settings.get_idp_data().get('entityId')
+        self.idp_certs = self._get_idp_signing_certs(self.settings)
+        self.idp_keys = [xmlsec.Key.from_memory(cert, xmlsec.KeyFormat.CERT_PEM) for cert in self.idp_certs]
+        sp_key = self.settings.get_sp_key()
+        self.sp_key = xmlsec.Key.from_memory(sp_key, xmlsec.KeyFormat.PEM) if sp_key else None
+
+    def __reduce__(self):
+        # Only the raw config crosses process boundaries; worker processes compile it once and reuse it.
+        return load_settings_snapshot, (self.fingerprint, self.config)
+
+    @staticmethod
+    def _get_idp_signing_certs(settings):
+        idp_data = settings.get_idp_data()
+        certs = list(idp_data.get('x509certMulti', {}).get('signing', []))
+        if idp_data.get('x509cert') and idp_data['x509cert'] not in certs:
+            certs.append(idp_data['x509cert'])
+        return certs
+
+
+def with_idp_signing_certs(config, certs):
+    """Return a copy of the settings that accepts IdP signatures made with any of the given certificates."""
+    config = copy.deepcopy(config)
+    config['idp'].setdefault('x509certMulti', dict())['signing'] = list(certs)
+    return config
+
+
+def load_settings_snapshot(fingerprint, config):
+    """Return the compiled snapshot for the given config, compiling it on first use in this process."""
+    snapshot = _compiled_snapshots.get(fingerprint)
+    if not snapshot:
+        snapshot = SamlSettingsSnapshot(config)
+        if len(_compiled_snapshots) >= MAX_COMPILED_SNAPSHOTS:
+            _compiled_snapshots.pop(next(iter(_compiled_snapshots)))
+        _compiled_snapshots[fingerprint] = snapshot
+    return snapshot
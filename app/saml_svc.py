@@ -1,22 +1,77 @@
+import asyncio
+import glob
+import importlib
 import json
+import multiprocessing
 import os
-import warnings
-warnings.filterwarnings('ignore', 'defusedxml.lxml is no longer supported and will be removed in a future release.', DeprecationWarning)
+import threading
+import time
 
 from aiohttp import web
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
 from pathlib import Path
-from onelogin.saml2.auth import OneLogin_Saml2_Auth
 
+from app.service.auth_svc import check_authorization
 from app.utility.base_service import BaseService
+from plugins.saml.app.saml_attribute_mapping import DEFAULT_CACHE_SIZE, AttributeMapper, load_attribute_mapper
+from plugins.saml.app.saml_config_watcher import DEFAULT_RELOAD_INTERVAL, SamlConfigWatcher
+from plugins.saml.app.saml_idp_registry import DEFAULT_IDP, IdpRegistry, split_plugin_settings
+from plugins.saml.app.saml_metrics import (OUTCOME_ERROR, OUTCOME_INVALID_RESPONSE, OUTCOME_MISSING_USERNAME,
+                                           OUTCOME_REJECTED, OUTCOME_REPLAY, OUTCOME_SIGNATURE_ERROR, OUTCOME_SUCCESS,
+                                           OUTCOME_UNKNOWN_USER, PROMETHEUS_CONTENT_TYPE, STAGE_ATTRIBUTE_EXTRACTION,
+                                           STAGE_AUTH_CONSTRUCTION, STAGE_FORM_PARSE, STAGE_LOGIN_REDIRECT,
+                                           STAGE_PROCESS_RESPONSE, STAGE_SUCCESSFUL_LOGIN, STAGE_USER_LOOKUP, STAGE_VERIFICATION_WAIT,
+                                           SamlLoginRejected, SamlMetrics)
+from plugins.saml.app.saml_prescan import prescan_saml_response
+from plugins.saml.app.saml_replay_cache import DEFAULT_MAX_ENTRIES, DEFAULT_MIN_TTL, create_replay_cache
+from plugins.saml.app.saml_request_gate import DEFAULT_MAX_BODY_SIZE, read_form
+
+# python3-saml, xmlsec and lxml are only imported on first use (see the function-level imports below), so that
+# loading the plugin does not pay for the XML security stack. They are first imported on a worker thread, together
+# with the first load of the settings files.
+SAML_STACK_MODULES = ('plugins.saml.app.saml_redirect', 'plugins.saml.app.saml_settings', 'plugins.saml.app.saml_verifier')
+
+DEFAULT_VERIFICATION_EXECUTOR = 'thread'
+DEFAULT_VERIFICATION_WORKERS = 4
+DEFAULT_CERT_OVERLAP = 86400
+METADATA_CHECK_INTERVAL = 10
+VERIFICATION_EXECUTORS = dict(thread=ThreadPoolExecutor, process=ProcessPoolExecutor)
 
 
 class SamlService(BaseService):
     def __init__(self):
         self.config_dir_path = os.path.join(Path(__file__).parents[1], 'conf')
         self.settings_path = os.path.join(self.config_dir_path, 'settings.json')
-        with open(self.settings_path, 'rb') as settings_file:
-            self._saml_config = json.load(settings_file)
+        self.idps_dir_path = os.path.join(self.config_dir_path, 'idps')
+        self.metadata_cache_dir_path = os.path.join(self.config_dir_path, 'metadata_cache')
+        self.attribute_mapping_path = os.path.join(self.config_dir_path, 'attribute_mapping.json')
         self.log = self.add_service('saml_svc', self)
+        self._verification_executor = None
+        self.metrics = SamlMetrics()
+        self._idp_registry = None
+        self._idp_registry_load = None
+        self._retired_idp_certs = dict()
+        self._metadata_sources = dict()
+        self._metadata_refresh_task = None
+        self._attribute_mapper = AttributeMapper()
+        self._cert_overlap = self._get_config_or_default('saml.reload.cert_overlap', DEFAULT_CERT_OVERLAP)
+        self._max_body_size = self.get_config('saml.max_body_size') or DEFAULT_MAX_BODY_SIZE
+        self._replay_cache = create_replay_cache(
+            backend=self.get_config('saml.replay_cache.backend') or 'memory',
+            path=self.get_config('saml.replay_cache.path') or os.path.join(self.config_dir_path, 'replay_cache.db'),
+            max_entries=self.get_config('saml.replay_cache.max_entries') or DEFAULT_MAX_ENTRIES,
+            min_ttl=self.get_config('saml.replay_cache.min_ttl') or DEFAULT_MIN_TTL,
+        )
+        self._redirect_engine = None
+        self._require_known_request = bool(self.get_config('saml.redirect.require_known_request'))
+        self._config_watcher = SamlConfigWatcher(
+            patterns=[self.settings_path, os.path.join(self.idps_dir_path, '*.json'), self.attribute_mapping_path],
+            reload=self.reload_idp_settings,
+            interval=self._get_config_or_default('saml.reload.interval', DEFAULT_RELOAD_INTERVAL),
+            log=self.log,
+        )
+        self._attribute_mapper = self._load_attribute_mapper(self._attribute_mapper)
 
     async def saml(self, request):
         """Handle SAML authentication."""
@@ -25,6 +80,7 @@ class SamlService(BaseService):
         except web.HTTPRedirection as http_redirect:
             raise http_redirect
         except Exception as e:
+            self.metrics.count_outcome(getattr(e, 'outcome', OUTCOME_ERROR))
             self.log.exception('Exception when handling /saml request: %s', e)
         self.log.debug('Redirecting to main login page')
         raise web.HTTPFound('/login')
@@ -37,76 +93,447 @@ class SamlService(BaseService):
             raise Exception('Auth service not available')
         await auth_svc.set_optional_login_handler(self)
 
-    async def get_saml_auth(self, request):
-        saml_response = await self._prepare_auth_parameter(request)
-        return OneLogin_Saml2_Auth(saml_response, self._saml_config)
+    @property
+    def auth_svc(self):
+        """The auth service, as required by the check_authorization decorator."""
+        return self.get_service('auth_svc')
+
+    @check_authorization
+    async def saml_metrics(self, request):
+        """Expose SAML login latency and outcome metrics in the Prometheus text format. Requires a logged-in
+        session or an API key.
+        """
+        return web.Response(text=self.metrics.render_prometheus(), headers={'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+    async def apply_saml_config(self, saml_config, idp_name=DEFAULT_IDP):
+        """Validate and precompile the given SAML settings on a worker thread, then use them for all subsequent
+        requests to the named identity provider.
+        """
+        await self._get_idp_registry()
+        from plugins.saml.app.saml_settings import SamlSettingsSnapshot
+        saml_config, plugin_config = split_plugin_settings(saml_config)
+        settings_snapshot = await asyncio.get_event_loop().run_in_executor(None, SamlSettingsSnapshot, saml_config)
+        self._idp_registry = self._idp_registry.with_idp(idp_name, settings_snapshot, plugin_config.get('hosts', []))
+        self.log.debug('Loaded SAML settings for identity provider "%s" (%s)', idp_name,
+                       settings_snapshot.idp_entity_id)
+
+    def watch_idp_settings(self):
+        """Load the SAML settings files in the background, then reload them and the IdP metadata whenever they
+        change.
+        """
+        self._start_loading_idp_settings()
+        self._config_watcher.start()
+        if not self._metadata_refresh_task:
+            self._metadata_refresh_task = asyncio.ensure_future(self._refresh_idp_metadata())
+
+    def start_warm_up(self):
+        """Schedule warm_up() in the background, unless disabled with saml.warm_up."""
+        if self._get_config_or_default('saml.warm_up', True):
+            asyncio.ensure_future(self.warm_up())
+
+    async def warm_up(self):
+        """Import the SAML stack, compile the settings and load the keys of every IdP, fill the AuthnRequest pools and
+        prepare every verification worker for the IdPs, all off the event loop, so that the first real login does not
+        pay for them.
+        """
+        start = perf_counter()
+        loop = asyncio.get_event_loop()
+        try:
+            idp_registry = await self._get_idp_registry()
+            for idp_name in idp_registry.names:
+                pool = self._get_redirect_engine().get_pool(idp_registry.get(idp_name))
+                await loop.run_in_executor(None, pool.fill)
+            if idp_registry.names:
+                await self._warm_up_verification_workers([idp_registry.get(idp_name) for idp_name in idp_registry.names])
+        except Exception as e:
+            self.log.warning('SAML warm-up failed: %s', e)
+            return
+        self.log.debug('SAML warm-up finished in %.3f seconds', perf_counter() - start)
+
+    async def reload_idp_settings(self):
+        """Read, validate and precompile the SAML settings files and attribute mapping rules on a worker thread, then
+        atomically swap in the new identity provider registry and attribute mapper. Requests already in progress
+        finish with the registry they started with. Returns the time at which the settings must be rebuilt to close
+        a certificate overlap window, if any, and schedules that rebuild whichever task triggered this reload.
+        """
+        loop = asyncio.get_event_loop()
+        idp_registry, retired_idp_certs = await loop.run_in_executor(None, self._build_idp_registry,
+                                                                     self._idp_registry or IdpRegistry(),
+                                                                     self._retired_idp_certs)
+        self._idp_registry, self._retired_idp_certs = idp_registry, retired_idp_certs
+        self._attribute_mapper = await loop.run_in_executor(None, self._load_attribute_mapper, self._attribute_mapper)
+        self.log.info('Reloaded SAML settings for identity providers: %s', ', '.join(idp_registry.names))
+        self._config_watcher.reload_at = min((expiry for certs in retired_idp_certs.values() for expiry in certs.values()),
+                                             default=None)
+        return self._config_watcher.reload_at
+
+    async def get_login_settings(self, idp_name=None, host=None):
+        """Return the precompiled settings of the IdP to redirect a login to, selected by name or host."""
+        settings_snapshot = (await self._get_idp_registry()).for_login(idp_name, host)
+        if not settings_snapshot:
+            raise Exception('No SAML identity provider configured for login to %s' % (idp_name or host))
+        return settings_snapshot
+
+    async def get_login_redirect(self, request, idp_name=None):
+        """Return the URL that redirects a login to the identity provider, built from a pooled AuthnRequest."""
+        settings_snapshot = await self.get_login_settings(idp_name, request.url.host)
+        with self.metrics.time_stage(STAGE_LOGIN_REDIRECT):
+            return self._get_redirect_engine().build_redirect(settings_snapshot, self._get_request_data(request))
+
+    async def verify_saml_response(self, request_data, settings_snapshot, request_id=None):
+        """Verify a SAML response on the verification worker pool, keeping the event loop responsive."""
+        from plugins.saml.app.saml_verifier import verify_saml_response
+        loop = asyncio.get_event_loop()
+        start = perf_counter()
+        verification = await loop.run_in_executor(self._get_verification_executor(), verify_saml_response,
+                                                  request_data, settings_snapshot, request_id)
+        worker_time = verification.timings['auth_construction'] + verification.timings['process_response']
+        self.metrics.observe(STAGE_VERIFICATION_WAIT, max(perf_counter() - start - worker_time, 0))
+        self.metrics.observe(STAGE_AUTH_CONSTRUCTION, verification.timings['auth_construction'])
+        self.metrics.observe(STAGE_PROCESS_RESPONSE, verification.timings['process_response'])
+        return verification
 
     async def _saml_login(self, request):
         self.log.debug('Handling login from SAML identity provider.')
-        saml_auth = await self.get_saml_auth(request)
-        saml_auth.process_response()
-        self._handle_saml_auth_errors(saml_auth)
-        await self._handle_app_authentication(request, saml_auth)
-
-    async def _handle_app_authentication(self, request, saml_auth):
-        if saml_auth.is_authenticated():
-            app_username = self._get_saml_login_username(saml_auth)
-            username_attr = self._get_saml_username_attribute(saml_auth)
+        idp_registry = await self._get_idp_registry()
+        request_data = await self._prepare_auth_parameter(request)
+        saml_response = request_data['post_data'].get('SAMLResponse')
+        prescan = prescan_saml_response(saml_response) if saml_response else None
+        settings_snapshot = idp_registry.for_issuer(prescan.issuer) if prescan else idp_registry.default
+        if not settings_snapshot:
+            raise SamlLoginRejected(OUTCOME_REJECTED, 'No SAML identity provider configured for issuer %s' %
+                                    (prescan.issuer if prescan else None))
+        request_id = None
+        if prescan:
+            self._check_saml_envelope(prescan, settings_snapshot, request_data)
+            if await self._call_replay_cache(self._replay_cache.is_replay, [prescan.response_id] + prescan.assertion_ids):
+                raise SamlLoginRejected(OUTCOME_REPLAY, 'Rejected replayed SAML response %s' % prescan.response_id)
+            request_id = self._get_issued_request_id(prescan)
+        verification = await self.verify_saml_response(request_data, settings_snapshot, request_id)
+        self._handle_saml_auth_errors(verification)
+        if verification.authenticated and not await self._call_replay_cache(
+                self._replay_cache.record, [verification.message_id, verification.assertion_id],
+                verification.not_on_or_after):
+            raise SamlLoginRejected(OUTCOME_REPLAY, 'Rejected replayed SAML response %s' % verification.message_id)
+        if verification.authenticated and request_id and \
+                not self._get_redirect_engine().issued_requests.consume(request_id):
+            raise SamlLoginRejected(OUTCOME_REPLAY, 'AuthnRequest %s has already been answered' % request_id)
+        await self._handle_app_authentication(request, verification)
+
+    async def _call_replay_cache(self, method, *args):
+        """Run a replay cache lookup or update, on a worker thread if the backend can block (e.g. on a file lock)."""
+        if self._replay_cache.blocking:
+            return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+        return method(*args)
+
+    async def _get_idp_registry(self):
+        """Return the IdP registry. The first caller starts loading the settings files on a worker thread, and
+        every caller waits for that one load instead of blocking the event loop.
+        """
+        if self._idp_registry is None:
+            await asyncio.shield(self._start_loading_idp_settings())
+        return self._idp_registry
+
+    def _start_loading_idp_settings(self):
+        if self._idp_registry is None and not self._idp_registry_load:
+            self._idp_registry_load = asyncio.ensure_future(self._load_idp_settings())
+        return self._idp_registry_load
+
+    def _get_redirect_engine(self):
+        if not self._redirect_engine:
+            from plugins.saml.app.saml_redirect import (DEFAULT_ISSUED_TTL, DEFAULT_MAX_AGE, DEFAULT_MAX_ISSUED,
+                                                        DEFAULT_POOL_SIZE, SamlRedirectEngine)
+            self._redirect_engine = SamlRedirectEngine(
+                pool_size=self.get_config('saml.redirect.pool_size') or DEFAULT_POOL_SIZE,
+                max_age=self.get_config('saml.redirect.max_age') or DEFAULT_MAX_AGE,
+                issued_ttl=self.get_config('saml.redirect.issued_ttl') or DEFAULT_ISSUED_TTL,
+                max_issued=self.get_config('saml.redirect.max_issued') or DEFAULT_MAX_ISSUED,
+            )
+        return self._redirect_engine
+
+    async def _load_idp_settings(self):
+        try:
+            idp_registry, retired_idp_certs = await asyncio.get_event_loop().run_in_executor(None, self._read_idp_settings)
+        except Exception:
+            self._idp_registry_load = None
+            raise
+        if not idp_registry.names:
+            self.log.warning('No SAML settings found in %s', self.config_dir_path)
+        if self._idp_registry is None:
+            # Settings reloaded while this load was running are newer, so they are kept.
+            self._idp_registry, self._retired_idp_certs = idp_registry, retired_idp_certs
+
+    def _read_idp_settings(self):
+        for module_name in SAML_STACK_MODULES:
+            importlib.import_module(module_name)
+        return self._build_idp_registry(IdpRegistry(), self._retired_idp_certs)
+
+    def _find_idp_settings(self):
+        idp_settings_paths = dict()
+        if os.path.exists(self.settings_path):
+            idp_settings_paths[DEFAULT_IDP] = self.settings_path
+        for idp_settings_path in sorted(glob.glob(os.path.join(self.idps_dir_path, '*.json'))):
+            idp_settings_paths[Path(idp_settings_path).stem] = idp_settings_path
+        return idp_settings_paths
+
+    def _build_idp_registry(self, current_registry, retired_idp_certs):
+        """Build a new registry from the settings files. An IdP whose new settings are invalid keeps its current
+        settings, and certificates dropped from an IdP's settings stay trusted until their overlap window ends.
+        """
+        now = time.time()
+        idp_registry = IdpRegistry()
+        new_retired_idp_certs = dict()
+        metadata_sources = dict()
+        for idp_name, idp_settings_path in self._find_idp_settings().items():
+            try:
+                with open(idp_settings_path, 'rb') as settings_file:
+                    saml_config, plugin_config = split_plugin_settings(json.load(settings_file))
+                if plugin_config.get('metadata'):
+                    metadata_source = self._get_metadata_source(idp_name, plugin_config['metadata'], saml_config)
+                    metadata_sources[idp_name] = metadata_source
+                    if not metadata_source.metadata:
+                        self.log.info('Identity provider "%s" is waiting for its metadata from %s', idp_name,
+                                      metadata_source.location)
+                        continue
+                    saml_config = metadata_source.merge_into(saml_config)
+                settings_snapshot, retired_certs = self._compile_idp_settings(
+                    saml_config, current_registry.get(idp_name), retired_idp_certs.get(idp_name, dict()), now)
+                idp_registry = idp_registry.with_idp(idp_name, settings_snapshot, plugin_config.get('hosts', []))
+            except Exception as e:
+                self.log.error('Invalid SAML settings in %s: %s', idp_settings_path, e)
+                settings_snapshot, retired_certs = current_registry.get(idp_name), retired_idp_certs.get(idp_name)
+                if not settings_snapshot:
+                    continue
+                self.log.warning('Keeping the previous SAML settings for identity provider "%s"', idp_name)
+                idp_registry = idp_registry.with_idp(idp_name, settings_snapshot, current_registry.get_hosts(idp_name))
+            if retired_certs:
+                new_retired_idp_certs[idp_name] = retired_certs
+        self._metadata_sources = metadata_sources
+        return idp_registry, new_retired_idp_certs
+
+    def _load_attribute_mapper(self, current_mapper):
+        try:
+            return load_attribute_mapper(self.attribute_mapping_path,
+                                         self.get_config('saml.attribute_mapping.cache_size') or DEFAULT_CACHE_SIZE)
+        except Exception as e:
+            self.log.error('Invalid SAML attribute mapping rules in %s: %s', self.attribute_mapping_path, e)
+            return current_mapper
+
+    def _get_metadata_source(self, idp_name, location, saml_config):
+        from plugins.saml.app.saml_metadata import (DEFAULT_REFRESH_INTERVAL, IdpMetadataSource, is_insecure_metadata,
+                                                    is_remote_metadata)
+        if not is_remote_metadata(location):
+            location = os.path.join(self.config_dir_path, location)
+        idp_config = saml_config.get('idp', dict())
+        cert_fingerprint = (idp_config.get('certFingerprint'), idp_config.get('certFingerprintAlgorithm') or 'sha1')
+        metadata_source = self._metadata_sources.get(idp_name)
+        if not metadata_source or metadata_source.location != location or \
+                (metadata_source.cert_fingerprint, metadata_source.cert_fingerprint_algorithm) != cert_fingerprint:
+            allow_http = bool(self.get_config('saml.metadata.allow_http'))
+            if allow_http and is_insecure_metadata(location):
+                self.log.warning('Fetching IdP metadata over plain http from %s; anyone on the network path can replace '
+                                 'the IdP signing certificate', location)
+            metadata_source = IdpMetadataSource(
+                location=location,
+                cache_path=os.path.join(self.metadata_cache_dir_path, '%s.json' % idp_name),
+                entity_id=idp_config.get('entityId'),
+                refresh_interval=self.get_config('saml.metadata.refresh_interval') or DEFAULT_REFRESH_INTERVAL,
+                allow_http=allow_http,
+                cert_fingerprint=cert_fingerprint[0],
+                cert_fingerprint_algorithm=cert_fingerprint[1],
+            )
+        if metadata_source.is_expired():
+            self.log.warning('IdP metadata from %s has expired; using it until it can be refreshed', location)
+        return metadata_source
+
+    async def _refresh_idp_metadata(self):
+        while True:
+            await self._refresh_metadata_sources()
+            await asyncio.sleep(METADATA_CHECK_INTERVAL)
+
+    async def _refresh_metadata_sources(self):
+        """Refresh the IdP metadata that is due and rebuild the settings if it changed. If the config watcher is not
+        running, also rebuild them when a certificate overlap window ends.
+        """
+        loop = asyncio.get_event_loop()
+        changed = False
+        for metadata_source in list(self._metadata_sources.values()):
+            if metadata_source.next_refresh > time.time():
+                continue
+            try:
+                changed = await loop.run_in_executor(None, metadata_source.refresh) or changed
+            except Exception as e:
+                self.log.warning('Failed to refresh IdP metadata from %s, keeping the cached copy: %s',
+                                 metadata_source.location, e)
+        reload_at = self._config_watcher.reload_at
+        if not self._config_watcher.running and reload_at and reload_at <= time.time():
+            changed = True
+        if changed:
+            try:
+                await self.reload_idp_settings()
+            except Exception as e:
+                self.log.error('Failed to apply refreshed IdP metadata: %s', e)
+
+    def _compile_idp_settings(self, saml_config, current_snapshot, retired_certs, now):
+        from plugins.saml.app.saml_settings import SamlSettingsSnapshot, with_idp_signing_certs
+        settings_snapshot = SamlSettingsSnapshot(saml_config)
+        new_retired_certs = {cert: expiry for cert, expiry in retired_certs.items()
+                             if expiry > now and cert not in settings_snapshot.idp_certs}
+        if current_snapshot and self._cert_overlap:
+            for cert in current_snapshot.idp_certs:
+                if cert not in retired_certs and cert not in settings_snapshot.idp_certs:
+                    self.log.info('IdP certificate rotated for %s; trusting the previous certificate for %d seconds',
+                                  settings_snapshot.idp_entity_id, self._cert_overlap)
+                    new_retired_certs[cert] = now + self._cert_overlap
+        if new_retired_certs:
+            settings_snapshot = SamlSettingsSnapshot(with_idp_signing_certs(
+                saml_config, settings_snapshot.idp_certs + list(new_retired_certs)))
+        return settings_snapshot, new_retired_certs
+
+    def _get_config_or_default(self, prop, default):
+        value = self.get_config(prop)
+        return default if value is None else value
+
+    def _get_verification_workers(self):
+        return self.get_config('saml.verification.workers') or DEFAULT_VERIFICATION_WORKERS
+
+    def _get_verification_executor(self):
+        if not self._verification_executor:
+            executor_type = self.get_config('saml.verification.executor') or DEFAULT_VERIFICATION_EXECUTOR
+            max_workers = self._get_verification_workers()
+            if executor_type not in VERIFICATION_EXECUTORS:
+                raise Exception('Unsupported SAML verification executor: %s' % executor_type)
+            self.log.debug('Starting SAML verification %s pool with %d workers', executor_type, max_workers)
+            self._verification_executor = VERIFICATION_EXECUTORS[executor_type](max_workers=max_workers)
+        return self._verification_executor
+
+    async def _warm_up_verification_workers(self, settings_snapshots):
+        from plugins.saml.app.saml_verifier import warm_up_verifier
+        loop = asyncio.get_event_loop()
+        executor = self._get_verification_executor()
+        workers = self._get_verification_workers()
+        manager = None
+        if isinstance(executor, ProcessPoolExecutor):
+            # Worker processes share the barrier through a manager process, which is stopped once they have passed it.
+            manager = await loop.run_in_executor(None, multiprocessing.Manager)
+            barrier = await loop.run_in_executor(None, manager.Barrier, workers)
+        else:
+            barrier = threading.Barrier(workers)
+        try:
+            await asyncio.gather(*[
+                loop.run_in_executor(executor, warm_up_verifier, settings_snapshots, barrier) for _ in range(workers)
+            ])
+        finally:
+            if manager:
+                await loop.run_in_executor(None, manager.shutdown)
+
+    async def _handle_app_authentication(self, request, verification):
+        if verification.authenticated:
+            with self.metrics.time_stage(STAGE_ATTRIBUTE_EXTRACTION):
+                app_username = self._attribute_mapper.map(verification.attributes) or \
+                    self._get_saml_login_username(verification)
+                username_attr = self._get_saml_username_attribute(verification)
             self.log.debug('Identity Provider provided application username: %s', app_username)
             self.log.debug('Identity Provider provided username attribute: %s', username_attr)
             if not username_attr:
-                raise Exception('No username attribute provided in SAML request. Required for auditing purposes.')
+                raise SamlLoginRejected(OUTCOME_MISSING_USERNAME, 'No username attribute provided in SAML request. Required for auditing purposes.')
             if app_username:
                 await self._validate_username(request, app_username, username_attr)
             else:
+                self.metrics.count_outcome(OUTCOME_MISSING_USERNAME)
                 self.log.error('No NameID or username attribute provided in SAML response.')
         else:
+            self.metrics.count_outcome(OUTCOME_INVALID_RESPONSE)
             self.log.warn('SAML request not authenticated.')
 
     async def _validate_username(self, request, app_username, username_attr):
         auth_svc = self.get_service('auth_svc')
         if not auth_svc:
             raise Exception('Auth service not available')
-        if app_username in auth_svc.user_map:
+        with self.metrics.time_stage(STAGE_USER_LOOKUP):
+            user_exists = app_username in auth_svc.user_map
+        if user_exists:
             # Will raise redirect on success
             self.log.info('User "%s" authenticated via SAML under application user "%s"',
                           username_attr, app_username)
-            await auth_svc.handle_successful_login(request, app_username)
+            with self.metrics.time_stage(STAGE_SUCCESSFUL_LOGIN):
+                try:
+                    await auth_svc.handle_successful_login(request, app_username)
+                except web.HTTPRedirection:
+                    self.metrics.count_outcome(OUTCOME_SUCCESS)
+                    raise
+            self.metrics.count_outcome(OUTCOME_SUCCESS)
         else:
+            self.metrics.count_outcome(OUTCOME_UNKNOWN_USER)
             self.log.warn('Application username "%s" not configured for login', app_username)
             self.log.info('User "%s" failed to authenticate via SAML under application user "%s"',
                           username_attr, app_username)
 
     @staticmethod
-    def _handle_saml_auth_errors(saml_auth):
-        errors = saml_auth.get_errors()
-        if errors:
-            combined_msg = ', '.join(errors)
-            raise Exception('Error when processing SAML response: %s' % combined_msg)
+    def _check_saml_envelope(prescan, settings_snapshot, request_data):
+        """Reject structurally invalid responses before they reach the (expensive) verification stage. Only
+        checks that python3-saml would also fail the response for are performed here.
+        """
+        from onelogin.saml2.utils import OneLogin_Saml2_Utils
+        if not prescan.has_signature and not prescan.has_encrypted_assertion:
+            raise SamlLoginRejected(OUTCOME_SIGNATURE_ERROR, 'SAML response %s is not signed' % prescan.response_id)
+        if settings_snapshot.settings.is_strict():
+            if not prescan.issuer and not prescan.has_encrypted_assertion:
+                raise SamlLoginRejected(OUTCOME_REJECTED, 'SAML response %s does not contain an Issuer' % prescan.response_id)
+            if prescan.issuer and prescan.issuer != settings_snapshot.idp_entity_id:
+                raise SamlLoginRejected(OUTCOME_REJECTED, 'SAML response issued by unexpected identity provider %s' % prescan.issuer)
+            current_url = OneLogin_Saml2_Utils.normalize_url(OneLogin_Saml2_Utils.get_self_url_no_query(request_data))
+            destination = prescan.destination
+            if destination is not None and not OneLogin_Saml2_Utils.normalize_url(destination).startswith(current_url):
+                raise SamlLoginRejected(OUTCOME_REJECTED, 'SAML response sent to %s instead of %s' % (prescan.destination, current_url))
+
+    def _get_issued_request_id(self, prescan):
+        """Return the ID of the AuthnRequest this response answers, if it was issued by this server. Unsolicited
+        and unknown responses are only refused when saml.redirect.require_known_request is set. The ID is only
+        consumed once the response has been verified, so that an invalid or forged response cannot use it up.
+        """
+        if prescan.in_response_to and self._get_redirect_engine().issued_requests.contains(prescan.in_response_to):
+            return prescan.in_response_to
+        if self._require_known_request:
+            raise SamlLoginRejected(OUTCOME_REJECTED, 'SAML response %s does not answer a known AuthnRequest' %
+                                    prescan.response_id)
+        return None
+
+    @staticmethod
+    def _handle_saml_auth_errors(verification):
+        if verification.errors:
+            combined_msg = ', '.join(verification.errors)
+            if verification.error_reason:
+                combined_msg = '%s (%s)' % (combined_msg, verification.error_reason)
+            outcome = OUTCOME_SIGNATURE_ERROR if 'signature' in combined_msg.lower() else OUTCOME_INVALID_RESPONSE
+            raise SamlLoginRejected(outcome, 'Error when processing SAML response: %s' % combined_msg)
+
+    async def _prepare_auth_parameter(self, request):
+        ret_parameters = self._get_request_data(request)
+        with self.metrics.time_stage(STAGE_FORM_PARSE):
+            ret_parameters['post_data'] = await read_form(request, self._max_body_size)
+        return ret_parameters
 
     @staticmethod
-    async def _prepare_auth_parameter(request):
-        ret_parameters = {
+    def _get_request_data(request):
+        return {
             'http_host': request.url.host,
             'script_name': request.url.path,
             'server_port': request.url.port,
             'get_data': request.url.query.copy(),
-            'post_data': (await request.post()).copy(),
         }
-        return ret_parameters
 
     @staticmethod
-    def _get_saml_login_username(saml_auth):
-        name_id = saml_auth.get_nameid()
-        if name_id:
-            return name_id
-        return SamlService._get_saml_username_attribute(saml_auth)
+    def _get_saml_login_username(verification):
+        if verification.name_id:
+            return verification.name_id
+        return SamlService._get_saml_username_attribute(verification)
 
     @staticmethod
-    def _get_saml_username_attribute(saml_auth):
+    def _get_saml_username_attribute(verification):
         """Returns the "username" attribute for the SAML request. This should be the username
         for the identity provider, not necessarily the username for the application.
         """
-        attributes = saml_auth.get_attributes()
+        attributes = verification.attributes
         username_attr_list = attributes.get('username', [])
         return username_attr_list[0] if len(username_attr_list) > 0 else None
@@ -0,0 +1,87 @@
+import warnings
+warnings.filterwarnings('ignore', 'defusedxml.lxml is no longer supported and will be removed in a future release.', DeprecationWarning)
+
+import time
+from collections import namedtuple
+
+from onelogin.saml2.auth import OneLogin_Saml2_Auth
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+
+WARM_UP_BARRIER_TIMEOUT = 30
+WARM_UP_DOCUMENT = ('<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+                    'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="warm-up" Version="2.0" '
+                    'IssueInstant="2000-01-01T00:00:00Z"><saml:Issuer>warm-up</saml:Issuer></samlp:Response>')
+
+
+SamlVerificationResult = namedtuple('SamlVerificationResult', [
+    'authenticated',
+    'name_id',
+    'attributes',
+    'session_index',
+    'errors',
+    'error_reason',
+    'message_id',
+    'assertion_id',
+    'not_on_or_after',
+    'timings',
+])
+
+
+def verify_saml_response(request_data, settings_snapshot, request_id=None):
+    """Runs the full python3-saml verification (decoding, XML parsing, schema and signature checks) for a
+    SAML response and returns a small picklable result. Designed to run inside a thread or process pool
+    executor so that the verification work never blocks the aiohttp event loop. If request_id is given, the
+    response must be InResponseTo that AuthnRequest.
+    """
+    start = time.perf_counter()
+    saml_auth = OneLogin_Saml2_Auth(request_data, settings_snapshot.settings)
+    constructed = time.perf_counter()
+    try:
+        saml_auth.process_response(request_id=request_id)
+    except Exception as e:
+        return SamlVerificationResult(authenticated=False, name_id=None, attributes={}, session_index=None,
+                                      errors=saml_auth.get_errors() or ['invalid_response'], error_reason=str(e),
+                                      message_id=None, assertion_id=None, not_on_or_after=None,
+                                      timings=_get_timings(start, constructed))
+    return SamlVerificationResult(
+        authenticated=saml_auth.is_authenticated(),
+        name_id=saml_auth.get_nameid(),
+        attributes=dict(saml_auth.get_attributes()),
+        session_index=saml_auth.get_session_index(),
+        errors=list(saml_auth.get_errors()),
+        error_reason=saml_auth.get_last_error_reason(),
+        message_id=saml_auth.get_last_message_id(),
+        assertion_id=saml_auth.get_last_assertion_id(),
+        not_on_or_after=saml_auth.get_last_assertion_not_on_or_after(),
+        timings=_get_timings(start, constructed),
+    )
+
+
+def warm_up_verifier(settings_snapshots, barrier=None):
+    """Prepare a verification worker for the given IdP settings and return the number of signatures it checked.
+    On a process pool, the snapshots are compiled (and their keys loaded) in the worker as they are received. For
+    settings that include an SP key and certificate, a document is signed with them and its signature checked the
+    way a response signature is. If a barrier is given, the call waits for it, so that each worker runs it once.
+    """
+    if barrier:
+        barrier.wait(WARM_UP_BARRIER_TIMEOUT)
+    signatures = 0
+    for settings_snapshot in settings_snapshots:
+        settings = settings_snapshot.settings
+        sp_key, sp_cert = settings.get_sp_key(), settings.get_sp_cert()
+        if not (sp_key and sp_cert):
+            continue
+        security = settings.get_security_data()
+        signed_document = OneLogin_Saml2_Utils.add_sign(WARM_UP_DOCUMENT, sp_key, sp_cert,
+                                                        sign_algorithm=security['signatureAlgorithm'],
+                                                        digest_algorithm=security['digestAlgorithm'])
+        if not OneLogin_Saml2_Utils.validate_sign(signed_document, multicerts=[sp_cert],
+                                                  xpath=OneLogin_Saml2_Utils.RESPONSE_SIGNATURE_XPATH):
+            raise Exception('Warm-up signature was rejected for identity provider %s' % settings_snapshot.idp_entity_id)
+        signatures += 1
+    return signatures
+
+
+def _get_timings(start, constructed):
+    return dict(auth_construction=constructed - start, process_response=time.perf_counter() - constructed)
@@ -0,0 +1,236 @@
+"""Load test for the SAML login path, driven by a local mock identity provider.
+
+The real CALDERA aiohttp application is started in-process with the SAML plugin pointed at a MockIdentityProvider.
+Fresh signed responses are minted before each run, so IdP-side signing is not part of the measurement. The `/saml`
+and login redirect routes are then driven at fixed concurrency levels. For each scenario the run reports
+requests/sec, p50/p95/p99 latency and event-loop lag, and compares them with a saved JSON baseline.
+
+Run from the CALDERA root directory:
+    python -m plugins.saml.benchmarks.load_test --concurrency 1 8 32 --requests 200
+    python -m plugins.saml.benchmarks.load_test --save-baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+import yaml
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from plugins.saml.benchmarks.mock_idp import MockIdentityProvider, generate_attributes
+
+CALDERA_ROOT = Path(__file__).parents[3]
+BASELINE_PATH = os.path.join(Path(__file__).parent, 'baselines', 'load_test.json')
+DEFAULT_CONCURRENCY = (1, 8, 32)
+DEFAULT_TOLERANCE = 0.2
+LAG_SAMPLE_INTERVAL = 0.005
+APP_USERNAME = 'red'
+
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up from short sleeps while a scenario is running."""
+
+    def __init__(self, interval=LAG_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._sample())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _sample(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - start - self.interval, 0))
+
+
+async def build_application():
+    """Start the CALDERA services and plugins the same way the plugin's test suite does."""
+    from app.api.rest_api import RestApi
+    from app.service.app_svc import AppService
+    from app.service.auth_svc import AuthService
+    from app.service.contact_svc import ContactService
+    from app.service.data_svc import DataService
+    from app.service.file_svc import FileSvc
+    from app.service.learning_svc import LearningService
+    from app.service.planning_svc import PlanningService
+    from app.service.rest_svc import RestService
+    from app.utility.base_world import BaseWorld
+    from plugins.saml.app.saml_login_handler import SamlLoginHandler
+
+    with open(CALDERA_ROOT / 'conf' / 'default.yml', 'r') as fle:
+        config = yaml.safe_load(fle)
+        config.get('plugins', []).append('saml')
+        BaseWorld.apply_config('main', config)
+    with open(CALDERA_ROOT / 'conf' / 'payloads.yml', 'r') as fle:
+        BaseWorld.apply_config('payloads', yaml.safe_load(fle))
+
+    app_svc = AppService(web.Application())
+    _ = DataService()
+    _ = RestService()
+    _ = PlanningService()
+    _ = LearningService()
+    auth_svc = AuthService()
+    _ = ContactService()
+    _ = FileSvc()
+    services = app_svc.get_services()
+    os.chdir(str(CALDERA_ROOT))
+
+    await app_svc.register_contacts()
+    await app_svc.load_plugins(['sandcat', 'ssl', 'saml'])
+    _ = await RestApi(services).enable()
+    await auth_svc.apply(app_svc.application, auth_svc.get_config('users'))
+    await auth_svc.set_login_handlers(services, SamlLoginHandler(services))
+    return app_svc.application, services['saml_svc']
+
+
+async def run_scenario(send_request, requests, concurrency):
+    """Issue the requests with at most `concurrency` in flight and return timing statistics."""
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    latencies = []
+    failures = 0
+
+    async def worker():
+        nonlocal failures
+        while not queue.empty():
+            request = queue.get_nowait()
+            start = time.perf_counter()
+            if not await send_request(request):
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await lag_monitor.stop()
+    return summarize(latencies, elapsed, lag_monitor.samples, failures)
+
+
+def summarize(latencies, elapsed, lag_samples, failures=0):
+    return dict(
+        requests=len(latencies),
+        failures=failures,
+        requests_per_second=len(latencies) / elapsed if elapsed else 0.0,
+        latency_p50=percentile(latencies, 50),
+        latency_p95=percentile(latencies, 95),
+        latency_p99=percentile(latencies, 99),
+        loop_lag_p99=percentile(lag_samples, 99),
+        loop_lag_max=max(lag_samples) if lag_samples else 0.0,
+    )
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return a description of every scenario whose throughput dropped or p95 latency rose beyond tolerance."""
+    regressions = []
+    for scenario, result in results.items():
+        expected = baseline.get(scenario)
+        if not expected:
+            continue
+        if result['requests_per_second'] < expected['requests_per_second'] * (1 - tolerance):
+            regressions.append('%s: %.1f req/s (baseline %.1f)' %
+                               (scenario, result['requests_per_second'], expected['requests_per_second']))
+        if result['latency_p95'] > expected['latency_p95'] * (1 + tolerance):
+            regressions.append('%s: p95 %.1f ms (baseline %.1f ms)' %
+                               (scenario, result['latency_p95'] * 1000, expected['latency_p95'] * 1000))
+    return regressions
+
+
+async def run_load_test(concurrency_levels, request_count, attribute_count, attribute_size):
+    application, saml_svc = await build_application()
+    server = TestServer(application, host='127.0.0.1')
+    await server.start_server()
+    base_url = str(server.make_url('')).rstrip('/')
+    idp = MockIdentityProvider()
+    await saml_svc.apply_saml_config(idp.sp_settings(base_url))
+    attributes = generate_attributes(attribute_count, attribute_size)
+    results = dict()
+    try:
+        async with aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar()) as session:
+            async def post_saml_response(saml_response):
+                async with session.post('%s/saml' % base_url, allow_redirects=False,
+                                        data=dict(SAMLResponse=saml_response, RelayState=base_url)) as resp:
+                    return resp.status == 302 and resp.headers.get('Location') == '/'
+
+            async def request_login_redirect(_):
+                async with session.post('%s/' % base_url, allow_redirects=False) as resp:
+                    return resp.status == 302 and resp.headers.get('Location', '').startswith(idp.sso_url)
+
+            for concurrency in concurrency_levels:
+                saml_responses = [idp.mint_response(base_url, APP_USERNAME, attributes) for _ in range(request_count)]
+                results['saml_post_c%d' % concurrency] = await run_scenario(post_saml_response, saml_responses,
+                                                                            concurrency)
+                results['login_redirect_c%d' % concurrency] = await run_scenario(request_login_redirect,
+                                                                                 range(request_count), concurrency)
+    finally:
+        await server.close()
+    return results
+
+
+def print_results(results):
+    print('%-22s %8s %8s %10s %9s %9s %9s %12s' %
+          ('scenario', 'requests', 'failures', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'lag p99 ms'))
+    for scenario, result in results.items():
+        print('%-22s %8d %8d %10.1f %9.2f %9.2f %9.2f %12.2f' % (
+            scenario, result['requests'], result['failures'], result['requests_per_second'],
+            result['latency_p50'] * 1000, result['latency_p95'] * 1000, result['latency_p99'] * 1000,
+            result['loop_lag_p99'] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the SAML login path against a local mock IdP')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY,
+                        help='concurrency levels to run each scenario at')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and concurrency level')
+    parser.add_argument('--attributes', type=int, default=10, help='number of extra attributes per response')
+    parser.add_argument('--attribute-size', type=int, default=64, help='size in characters of each extra attribute')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path of the JSON baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed fractional regression against the baseline')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run_load_test(args.concurrency, args.requests, args.attributes,
+                                                    args.attribute_size))
+    print_results(results)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4, sort_keys=True)
+        print('Saved baseline to %s' % args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = compare_with_baseline(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""A local stand-in identity provider that mints fresh, signed SAML responses for tests and benchmarks.
+
+A throwaway RSA key pair and self-signed certificate are generated for every MockIdentityProvider, so responses
+never expire in the repository and no real IdP is needed.
+"""
+import base64
+import datetime
+import uuid
+from xml.sax.saxutils import escape, quoteattr
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+DEFAULT_ENTITY_ID = 'http://mock-idp.caldera.local/'
+DEFAULT_SSO_URL = 'http://mock-idp.caldera.local/sso'
+RESPONSE_LIFETIME = datetime.timedelta(minutes=5)
+
+_RESPONSE_TEMPLATE = (
+    '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+    'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="{response_id}" Version="2.0" '
+    'IssueInstant="{now}" Destination={acs_url}{in_response_to}>'
+    '<saml:Issuer>{entity_id}</saml:Issuer>'
+    '<samlp:Status><samlp:StatusCode Value="urn:oasis:names:tc:SAML:2.0:status:Success"/></samlp:Status>'
+    '{assertion}'
+    '</samlp:Response>'
+)
+_ASSERTION_TEMPLATE = (
+    '<saml:Assertion xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="{assertion_id}" Version="2.0" '
+    'IssueInstant="{now}">'
+    '<saml:Issuer>{entity_id}</saml:Issuer>'
+    '<saml:Subject>'
+    '<saml:NameID Format="urn:oasis:names:tc:SAML:1.1:nameid-format:unspecified">{name_id}</saml:NameID>'
+    '<saml:SubjectConfirmation Method="urn:oasis:names:tc:SAML:2.0:cm:bearer">'
+    '<saml:SubjectConfirmationData NotOnOrAfter="{not_on_or_after}" Recipient={acs_url}{in_response_to}/>'
+    '</saml:SubjectConfirmation>'
+    '</saml:Subject>'
+    '<saml:Conditions NotBefore="{not_before}" NotOnOrAfter="{not_on_or_after}">'
+    '<saml:AudienceRestriction><saml:Audience>{sp_entity_id}</saml:Audience></saml:AudienceRestriction>'
+    '</saml:Conditions>'
+    '<saml:AuthnStatement AuthnInstant="{now}" SessionIndex="{session_index}">'
+    '<saml:AuthnContext><saml:AuthnContextClassRef>'
+    'urn:oasis:names:tc:SAML:2.0:ac:classes:PasswordProtectedTransport'
+    '</saml:AuthnContextClassRef></saml:AuthnContext>'
+    '</saml:AuthnStatement>'
+    '<saml:AttributeStatement>{attributes}</saml:AttributeStatement>'
+    '</saml:Assertion>'
+)
+_METADATA_TEMPLATE = (
+    '<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" '
+    'xmlns:ds="http://www.w3.org/2000/09/xmldsig#" entityID={entity_id} validUntil="{valid_until}" '
+    'cacheDuration="{cache_duration}">'
+    '<md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">'
+    '<md:KeyDescriptor use="signing"><ds:KeyInfo><ds:X509Data><ds:X509Certificate>{cert}</ds:X509Certificate>'
+    '</ds:X509Data></ds:KeyInfo></md:KeyDescriptor>'
+    '<md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect" Location={sso_url}/>'
+    '</md:IDPSSODescriptor>'
+    '</md:EntityDescriptor>'
+)
+_ATTRIBUTE_TEMPLATE = (
+    '<saml:Attribute Name={name} NameFormat="urn:oasis:names:tc:SAML:2.0:attrname-format:basic">{values}'
+    '</saml:Attribute>'
+)
+_ATTRIBUTE_VALUE_TEMPLATE = (
+    '<saml:AttributeValue xmlns:xs="http://www.w3.org/2001/XMLSchema" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="xs:string">{value}</saml:AttributeValue>'
+)
+
+
+class MockIdentityProvider:
+
+    def __init__(self, entity_id=DEFAULT_ENTITY_ID, sso_url=DEFAULT_SSO_URL, key_size=2048):
+        self.entity_id = entity_id
+        self.sso_url = sso_url
+        self.private_key_pem, self.cert_pem = self._generate_key_pair(entity_id, key_size)
+
+    def sp_settings(self, sp_base_url, strict=True):
+        """Return python3-saml settings for a CALDERA server at sp_base_url that trusts this IdP."""
+        return {
+            'strict': strict,
+            'debug': False,
+            'sp': {
+                'entityId': sp_base_url,
+                'assertionConsumerService': {
+                    'url': '%s/saml' % sp_base_url,
+                    'binding': OneLogin_Saml2_Constants.BINDING_HTTP_POST,
+                },
+            },
+            'idp': {
+                'entityId': self.entity_id,
+                'singleSignOnService': {
+                    'url': self.sso_url,
+                    'binding': OneLogin_Saml2_Constants.BINDING_HTTP_REDIRECT,
+                },
+                'x509cert': self.cert_pem,
+            },
+            'security': {
+                'wantMessagesSigned': True,
+                'wantAssertionsSigned': True,
+                'wantAttributeStatement': True,
+            },
+        }
+
+    def metadata(self, valid_for=datetime.timedelta(days=1), cache_duration='PT1H'):
+        """Return SAML metadata XML describing this IdP."""
+        return _METADATA_TEMPLATE.format(
+            entity_id=quoteattr(self.entity_id),
+            valid_until=_format_time(datetime.datetime.utcnow() + valid_for),
+            cache_duration=cache_duration,
+            cert=''.join(line for line in self.cert_pem.splitlines() if not line.startswith('-----')),
+            sso_url=quoteattr(self.sso_url),
+        )
+
+    def mint_response(self, sp_base_url, name_id, attributes=None, in_response_to=None, sign_assertion=True,
+                      sign_response=True):
+        """Return a fresh base64-encoded SAMLResponse for the given NameID and attributes."""
+        now = datetime.datetime.utcnow()
+        acs_url = quoteattr('%s/saml' % sp_base_url)
+        in_response_to = ' InResponseTo=%s' % quoteattr(in_response_to) if in_response_to else ''
+        values = dict(
+            response_id=_generate_id(),
+            assertion_id=_generate_id(),
+            session_index=_generate_id(),
+            now=_format_time(now),
+            not_before=_format_time(now - RESPONSE_LIFETIME),
+            not_on_or_after=_format_time(now + RESPONSE_LIFETIME),
+            acs_url=acs_url,
+            in_response_to=in_response_to,
+            entity_id=escape(self.entity_id),
+            sp_entity_id=escape(sp_base_url),
+            name_id=escape(name_id),
+            attributes=''.join(_render_attribute(name, value) for name, value in (attributes or {}).items()),
+        )
+        assertion = _ASSERTION_TEMPLATE.format(**values)
+        if sign_assertion:
+            assertion = self._sign(assertion)
+        response = _RESPONSE_TEMPLATE.format(assertion=assertion, **values)
+        if sign_response:
+            response = self._sign(response)
+        return base64.b64encode(response.encode('utf-8')).decode('ascii')
+
+    def _sign(self, xml):
+        signed = OneLogin_Saml2_Utils.add_sign(xml, self.private_key_pem, self.cert_pem,
+                                               sign_algorithm=OneLogin_Saml2_Constants.RSA_SHA256,
+                                               digest_algorithm=OneLogin_Saml2_Constants.SHA256)
+        signed = signed.decode('utf-8') if isinstance(signed, bytes) else signed
+        return signed.split('?>', 1)[1] if signed.startswith('<?xml') else signed
+
+    @staticmethod
+    def _generate_key_pair(entity_id, key_size):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=key_size, backend=default_backend())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'CALDERA SAML mock IdP')])
+        now = datetime.datetime.utcnow()
+        cert = x509.CertificateBuilder() \
+            .subject_name(name) \
+            .issuer_name(name) \
+            .public_key(key.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)) \
+            .not_valid_after(now + datetime.timedelta(days=1)) \
+            .sign(key, hashes.SHA256(), default_backend())
+        private_key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                            serialization.NoEncryption()).decode('ascii')
+        return private_key_pem, cert.public_bytes(serialization.Encoding.PEM).decode('ascii')
+
+
+def generate_attributes(attribute_count, attribute_size, username='mock-user@caldera.local'):
+    """Return a "username" attribute plus attribute_count filler attributes of attribute_size characters."""
+    attributes = dict(username=[username])
+    for index in range(attribute_count):
+        attributes['attribute%d' % index] = ['x' * attribute_size]
+    return attributes
+
+
+def _render_attribute(name, values):
+    return _ATTRIBUTE_TEMPLATE.format(
+        name=quoteattr(name),
+        values=''.join(_ATTRIBUTE_VALUE_TEMPLATE.format(value=escape(value)) for value in values),
+    )
+
+
+def _generate_id():
+    return '_' + uuid.uuid4().hex
+
+
+def _format_time(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -0,0 +1,47 @@
+"""Micro-benchmark for the per-request cost of constructing the python3-saml auth object, comparing the
+previous approach (building it from the raw settings dict) with reusing a precompiled settings snapshot.
+
+Run from the CALDERA root directory:
+    python -m plugins.saml.benchmarks.settings_construction [--settings plugins/saml/conf/settings.json]
+"""
+import argparse
+import json
+import os
+import timeit
+from pathlib import Path
+
+from onelogin.saml2.auth import OneLogin_Saml2_Auth
+
+from plugins.saml.app.saml_settings import SamlSettingsSnapshot
+
+DEFAULT_SETTINGS_PATH = os.path.join(Path(__file__).parents[1], 'conf', 'settings.json')
+REQUEST_DATA = dict(http_host='localhost', script_name='/saml', server_port=8888, get_data={}, post_data={})
+
+
+def run_benchmark(saml_config, iterations):
+    snapshot = SamlSettingsSnapshot(saml_config)
+    from_dict = timeit.timeit(lambda: OneLogin_Saml2_Auth(REQUEST_DATA, saml_config), number=iterations)
+    from_snapshot = timeit.timeit(lambda: OneLogin_Saml2_Auth(REQUEST_DATA, snapshot.settings), number=iterations)
+    return dict(
+        iterations=iterations,
+        raw_dict_usec=from_dict / iterations * 1e6,
+        snapshot_usec=from_snapshot / iterations * 1e6,
+        speedup=from_dict / from_snapshot,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure per-request SAML settings construction cost')
+    parser.add_argument('--settings', default=DEFAULT_SETTINGS_PATH, help='path to the SAML settings JSON file')
+    parser.add_argument('--iterations', type=int, default=2000, help='number of constructions to time')
+    args = parser.parse_args()
+    with open(args.settings, 'rb') as settings_file:
+        saml_config = json.load(settings_file)
+    results = run_benchmark(saml_config, args.iterations)
+    print('Auth object from raw settings dict:  %8.1f usec/request' % results['raw_dict_usec'])
+    print('Auth object from settings snapshot:  %8.1f usec/request' % results['snapshot_usec'])
+    print('Speedup: %.1fx over %d iterations' % (results['speedup'], results['iterations']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,14 @@
-from plugins.saml.app.saml_svc import SamlService
-
 name = 'SAML'
 description = 'A plugin that provides SAML authentication for CALDERA'
 address = None
 
 
 async def enable(services):
+    # Imported here so that loading the plugin list does not import the SAML service and its dependencies.
+    from plugins.saml.app.saml_svc import SamlService
     app = services.get('app_svc').application
     saml_svc = SamlService()
     app.router.add_route('*', '/saml', saml_svc.saml)
+    app.router.add_route('GET', '/plugin/saml/metrics', saml_svc.saml_metrics)
+    saml_svc.watch_idp_settings()
+    saml_svc.start_warm_up()
@@ -1,9 +1,23 @@
+import asyncio
+import base64
+import copy
+import hashlib
+import json
 import os
+import pickle
 import pytest
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
 import yaml
+import zlib
 
 from http import HTTPStatus
 from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
 from aiohttp import web
 
 from app.api.rest_api import RestApi
@@ -17,7 +31,20 @@ from app.service.planning_svc import PlanningService
 from app.service.rest_svc import RestService
 from app.utility.base_service import BaseService
 from app.utility.base_world import BaseWorld
+from plugins.saml.app.saml_attribute_mapping import AttributeMapper
+from plugins.saml.app.saml_config_watcher import SamlConfigWatcher
+from plugins.saml.app.saml_idp_registry import IdpRegistry, split_plugin_settings
 from plugins.saml.app.saml_login_handler import SamlLoginHandler
+from plugins.saml.app.saml_metadata import IdpMetadataSource
+from plugins.saml.app.saml_metrics import SamlMetrics
+from plugins.saml.app.saml_prescan import prescan_saml_response
+from plugins.saml.app.saml_redirect import AuthnRequestPool, IssuedRequestIndex
+from plugins.saml.app.saml_replay_cache import AssertionReplayCache, MemoryReplayBackend, SqliteReplayBackend, create_replay_cache
+from plugins.saml.app.saml_settings import SamlSettingsSnapshot
+from plugins.saml.app.saml_svc import SamlService
+from plugins.saml.app.saml_verifier import verify_saml_response, warm_up_verifier
+from plugins.saml.benchmarks.load_test import compare_with_baseline, summarize
+from plugins.saml.benchmarks.mock_idp import MockIdentityProvider, generate_attributes
 
 
 VALID_RESPONSE_B64 = 'PD94bWwgdmVyc2lvbj0iMS4wIiBlbmNvZGluZz0iVVRGLTgiPz48c2FtbDJwOlJlc3BvbnNlIERlc3RpbmF0aW9uPSJodHRwOi8vbG9jYWxob3N0Ojg4ODgvc2FtbCIgSUQ9ImlkNzcyNzY5MzQzNzA4NjU1NTIxMzYxMDg2MjgiIEluUmVzcG9uc2VUbz0iT05FTE9HSU5fYTg2YzY4MGIxNmUzY2ZlZjlmNjYwNjIyMTBiZGIwMzAzNDkwNjk2OSIgSXNzdWVJbnN0YW50PSIyMDIxLTA0LTE5VDE1OjExOjQ4LjQ5N1oiIFZlcnNpb249IjIuMCIgeG1sbnM6c2FtbDJwPSJ1cm46b2FzaXM6bmFtZXM6dGM6U0FNTDoyLjA6cHJvdG9jb2wiIHhtbG5zOnhzPSJodHRwOi8vd3d3LnczLm9yZy8yMDAxL1hNTFNjaGVtYSI+PHNhbWwyOklzc3VlciBGb3JtYXQ9InVybjpvYXNpczpuYW1lczp0YzpTQU1MOjIuMDpuYW1laWQtZm9ybWF0OmVudGl0eSIgeG1sbnM6c2FtbDI9InVybjpvYXNpczpuYW1lczp0YzpTQU1MOjIuMDphc3NlcnRpb24iPmh0dHA6Ly93d3cub2t0YS5jb20vZXhrYm1kaTlhdnBpd3RhblY1ZDY8L3NhbWwyOklzc3Vlcj48ZHM6U2lnbmF0dXJlIHhtbG5zOmRzPSJodHRwOi8vd3d3LnczLm9yZy8yMDAwLzA5L3htbGRzaWcjIj48ZHM6U2lnbmVkSW5mbz48ZHM6Q2Fub25pY2FsaXphdGlvbk1ldGhvZCBBbGdvcml0aG09Imh0dHA6Ly93d3cudzMub3JnLzIwMDEvMTAveG1sLWV4Yy1jMTRuIyIvPjxkczpTaWduYXR1cmVNZXRob2QgQWxnb3JpdGhtPSJodHRwOi8vd3d3LnczLm9yZy8yMDAxLzA0L3htbGRzaWctbW9yZSNyc2Etc2hhMjU2Ii8+PGRzOlJlZmVyZW5jZSBVUkk9IiNpZDc3Mjc2OTM0MzcwODY1NTUyMTM2MTA4NjI4Ij48ZHM6VHJhbnNmb3Jtcz48ZHM6VHJhbnNmb3JtIEFsZ29yaXRobT0iaHR0cDovL3d3dy53My5vcmcvMjAwMC8wOS94bWxkc2lnI2VudmVsb3BlZC1zaWduYXR1cmUiLz48ZHM6VHJhbnNmb3JtIEFsZ29yaXRobT0iaHR0cDovL3d3dy53My5vcmcvMjAwMS8xMC94bWwtZXhjLWMxNG4jIj48ZWM6SW5jbHVzaXZlTmFtZXNwYWNlcyBQcmVmaXhMaXN0PSJ4cyIgeG1sbnM6ZWM9Imh0dHA6Ly93d3cudzMub3JnLzIwMDEvMTAveG1sLWV4Yy1jMTRuIyIvPjwvZHM6VHJhbnNmb3JtPjwvZHM6VHJhbnNmb3Jtcz48ZHM6RGlnZXN0TWV0aG9kIEFsZ29yaXRobT0iaHR0cDovL3d3dy53My5vcmcvMjAwMS8wNC94bWxlbmMjc2hhMjU2Ii8+PGRzOkRpZ2VzdFZhbHVlPjl5WS94S0xwZHV1TSs0SE5vcnQraE05U3lKNzhvRVhQOXFTSUlsNG94VW89PC9kczpEaWdlc3RWYWx1ZT48L2RzOlJlZmVyZW5jZT48L2RzOlNpZ25lZEluZm8+PGRzOlNpZ25hdHVyZVZhbHVlPmVUTnpQV2k5cEdMTEdUSzNsY2NlbGNqa2RIczdhdE56bE8xMWtnMWgvY3dtcmxUMVRya1FUSDk1bmRrZ2J2Y3hBUXNHZnY4bHY3UDZHMHpLMWFHZ2ZydnJKaG1HYVZVTGR2aDFMdFB4MFFBS1pseFRkdmxjWFowT3EyeFA1NlQ5Q1M0ZGhKc2xQbTJOdW50bzl3UkVsa201UWpPb3B1ZjRDczBBZkhZTVVrOGxaTWhTUWdsSjhWTms1MDlwVVlpNzYxYW1yN1dvbExFUXpaTEsvWlZoSm0rWnNPTm4yN0JDUDJ6aStNUzlObVF4d0swYlNLSTRKdG1sODBJQll5ZGtuVUhObHNzZ2UzOUdqN1FFQUYycFUzd3hqdCtUZ29Ed2RCQmQzUHN2cmVWWXpQV3lWcndqeGdzRmhJdWIvcmFRWG9TUFV4Zmtuc1Ywa2VtaFhHejg1UT09PC9kczpTaWduYXR1cmVWYWx1ZT48ZHM6S2V5SW5mbz48ZHM6WDUwOURhdGE+PGRzOlg1MDlDZXJ0aWZpY2F0ZT5NSUlEcURDQ0FwQ2dBd0lCQWdJR0FYZGl0cU1XTUEwR0NTcUdTSWIzRFFFQkN3VUFNSUdVTVFzd0NRWURWUVFHRXdKVlV6RVRNQkVHCkExVUVDQXdLUTJGc2FXWnZjbTVwWVRFV01CUUdBMVVFQnd3TlUyRnVJRVp5WVc1amFYTmpiekVOTUFzR0ExVUVDZ3dFVDJ0MFlURVUKTUJJR0ExVUVDd3dMVTFOUFVISnZkbWxrWlhJeEZUQVRCZ05WQkFNTURHUmxkaTAyT1RFek16QTBOekVjTUJvR0NTcUdTSWIzRFFFSgpBUllOYVc1bWIwQnZhM1JoTG1OdmJUQWVGdzB5TVRBeU1ESXhNakkyTlRKYUZ3MHpNVEF5TURJeE1qSTNOVEphTUlHVU1Rc3dDUVlEClZRUUdFd0pWVXpFVE1CRUdBMVVFQ0F3S1EyRnNhV1p2Y201cFlURVdNQlFHQTFVRUJ3d05VMkZ1SUVaeVlXNWphWE5qYnpFTk1Bc0cKQTFVRUNnd0VUMnQwWVRFVU1CSUdBMVVFQ3d3TFUxTlBVSEp2ZG1sa1pYSXhGVEFUQmdOVkJBTU1ER1JsZGkwMk9URXpNekEwTnpFYwpNQm9HQ1NxR1NJYjNEUUVKQVJZTmFXNW1iMEJ2YTNSaExtTnZiVENDQVNJd0RRWUpLb1pJaHZjTkFRRUJCUUFEZ2dFUEFEQ0NBUW9DCmdnRUJBSXozdlNpd1ZXcjdpVXlLSE1wQUNqbGdTSlVLcmxsNXFzWFRsOGNYNUZrai9PZ0FhV0lCV2Nwa3BkVDdpQVJTd3FRaGNUWU4KZkhTc09rblRjT0QxdWgxeWpNNXljQ1F4MFVPL24wNithcFAxR2FoRE5mTEZmYnQyS0xDMUZ2Y21NcXo4QVVCL0VFWHZ4VlNrbjBvVQpLSVlZZTlqQkxHSWg2ZlFVZEtmbGpTdjZVeC9SVXRUS1Job09TeE9uTHJYOEhQN2ZIQWpTWmZQVjhPRG9tdVZBdWVPd2l0YVlFZitRClJCbXhDM295eDliTWpmT3VzV1VybFZlTHdPck9oNENKQlpacnhSakFScDVwMGpleEloNDA1QTRjUzNtK1I1Y1ArOWpXNkdWbmhpRW8KckpaT24xZDhPdVoxbkN2STlGWlBzZjVuZ2R3cEtXMFQrekN1UU1xODB0a0NBd0VBQVRBTkJna3Foa2lHOXcwQkFRc0ZBQU9DQVFFQQpWbm5SVjBWaEJrY2NhTzEyb3BEeE5CUnRXVlNQa2I1Mm5NV0RhWFZFNUoySDBnbkwrOVpyRm5sTk1tUkllcWtTZUdGRzZodmJXeHJJCmNXN1FTc1REbU1mV3l4RmplZjUvOXFIR2hMQ0ltRkxCa3JhVytPeFptQzI5ZnRPb2NKQXpYQUd3SmFkYXFyRG4zOEJsZ3p3SlNEUmUKMXhnaFhSTmJZYWVqeUdtQ29OdXJpVlhiTkpGaG9GVTlKc1hlVkN3MWdaOUhYUDk4VWQwNmMvTXpyY2hsd01wU0xacHU2SGd0dWxMTgpPVEgremFrcG1qM25WbmNWb0k4cjQ5ZmNqb1MwODExdmZDM2UvNHlNK1R4MG4zQno2UmFDbnIrcjBrRzBPMmQwcnpMWVdicnpJQWNFCnU0eTdZSWk2eW01dDhWWWpZbHNNYXJUME9RWXBwcCs2V3RpRjNnPT08L2RzOlg1MDlDZXJ0aWZpY2F0ZT48L2RzOlg1MDlEYXRhPjwvZHM6S2V5SW5mbz48L2RzOlNpZ25hdHVyZT48c2FtbDJwOlN0YXR1cyB4bWxuczpzYW1sMnA9InVybjpvYXNpczpuYW1lczp0YzpTQU1MOjIuMDpwcm90b2NvbCI+PHNhbWwycDpTdGF0dXNDb2RlIFZhbHVlPSJ1cm46b2FzaXM6bmFtZXM6dGM6U0FNTDoyLjA6c3RhdHVzOlN1Y2Nlc3MiLz48L3NhbWwycDpTdGF0dXM+PHNhbWwyOkFzc2VydGlvbiBJRD0iaWQ3NzI3NjkzNDM3MTU3MjI4MzI2MjI2MzY0IiBJc3N1ZUluc3RhbnQ9IjIwMjEtMDQtMTlUMTU6MTE6NDguNDk3WiIgVmVyc2lvbj0iMi4wIiB4bWxuczpzYW1sMj0idXJuOm9hc2lzOm5hbWVzOnRjOlNBTUw6Mi4wOmFzc2VydGlvbiIgeG1sbnM6eHM9Imh0dHA6Ly93d3cudzMub3JnLzIwMDEvWE1MU2NoZW1hIj48c2FtbDI6SXNzdWVyIEZvcm1hdD0idXJuOm9hc2lzOm5hbWVzOnRjOlNBTUw6Mi4wOm5hbWVpZC1mb3JtYXQ6ZW50aXR5IiB4bWxuczpzYW1sMj0idXJuOm9hc2lzOm5hbWVzOnRjOlNBTUw6Mi4wOmFzc2VydGlvbiI+aHR0cDovL3d3dy5va3RhLmNvbS9leGtibWRpOWF2cGl3dGFuVjVkNjwvc2FtbDI6SXNzdWVyPjxkczpTaWduYXR1cmUgeG1sbnM6ZHM9Imh0dHA6Ly93d3cudzMub3JnLzIwMDAvMDkveG1sZHNpZyMiPjxkczpTaWduZWRJbmZvPjxkczpDYW5vbmljYWxpemF0aW9uTWV0aG9kIEFsZ29yaXRobT0iaHR0cDovL3d3dy53My5vcmcvMjAwMS8xMC94bWwtZXhjLWMxNG4jIi8+PGRzOlNpZ25hdHVyZU1ldGhvZCBBbGdvcml0aG09Imh0dHA6Ly93d3cudzMub3JnLzIwMDEvMDQveG1sZHNpZy1tb3JlI3JzYS1zaGEyNTYiLz48ZHM6UmVmZXJlbmNlIFVSST0iI2lkNzcyNzY5MzQzNzE1NzIyODMyNjIyNjM2NCI+PGRzOlRyYW5zZm9ybXM+PGRzOlRyYW5zZm9ybSBBbGdvcml0aG09Imh0dHA6Ly93d3cudzMub3JnLzIwMDAvMDkveG1sZHNpZyNlbnZlbG9wZWQtc2lnbmF0dXJlIi8+PGRzOlRyYW5zZm9ybSBBbGdvcml0aG09Imh0dHA6Ly93d3cudzMub3JnLzIwMDEvMTAveG1sLWV4Yy1jMTRuIyI+PGVjOkluY2x1c2l2ZU5hbWVzcGFjZXMgUHJlZml4TGlzdD0ieHMiIHhtbG5zOmVjPSJodHRwOi8vd3d3LnczLm9yZy8yMDAxLzEwL3htbC1leGMtYzE0biMiLz48L2RzOlRyYW5zZm9ybT48L2RzOlRyYW5zZm9ybXM+PGRzOkRpZ2VzdE1ldGhvZCBBbGdvcml0aG09Imh0dHA6Ly93d3cudzMub3JnLzIwMDEvMDQveG1sZW5jI3NoYTI1NiIvPjxkczpEaWdlc3RWYWx1ZT5ZT1IyWnlhdGpOMEhlK1AxbFQycmJCaTczUWZQdVBjeTQ1encvQkpFY2JnPTwvZHM6RGlnZXN0VmFsdWU+PC9kczpSZWZlcmVuY2U+PC9kczpTaWduZWRJbmZvPjxkczpTaWduYXR1cmVWYWx1ZT5JVjNjT0pKR2N2dHo5VFJoWGhpZHluTm1wR0tEVm1VSmlPTnJqRmV4emhHSEYvbHdWRmFINnVWSXM4UFRoeUU3VFJYWUFYM1M1WkRVRys1OVVhcnlDZ3RHZ2JLVEZLcHlsOWU5ZEtibkI4Y2xPaEZCNHB6VlFpTzlIN2NmRGVhZ2hWL2xDQXFKVDV1SEZzRC85VldSVlN1UVBLeDFvNlVMZDJicHE2UFVwZGxtaDFqYythY2pLemNJN3BuL3pNTFFhYkxHb2c4cFRWMk9jTTVkOWdXZjB3T2VaNnR4bUhOeE1kb2JOaHY4cWxObkk1dzdIRmNUTmJpSU9aSE5jWWtqZFZUTXNKUFFac1paa2FOejNSMDRSaXVWM21sRGk2UFN2U3FlMDlEUmp2Z1lkdTRhNFlSRHhIMmxiajY3bGdkNm5aQ3BWTStKdjRhek93eCtKYnJQU1E9PTwvZHM6U2lnbmF0dXJlVmFsdWU+PGRzOktleUluZm8+PGRzOlg1MDlEYXRhPjxkczpYNTA5Q2VydGlmaWNhdGU+TUlJRHFEQ0NBcENnQXdJQkFnSUdBWGRpdHFNV01BMEdDU3FHU0liM0RRRUJDd1VBTUlHVU1Rc3dDUVlEVlFRR0V3SlZVekVUTUJFRwpBMVVFQ0F3S1EyRnNhV1p2Y201cFlURVdNQlFHQTFVRUJ3d05VMkZ1SUVaeVlXNWphWE5qYnpFTk1Bc0dBMVVFQ2d3RVQydDBZVEVVCk1CSUdBMVVFQ3d3TFUxTlBVSEp2ZG1sa1pYSXhGVEFUQmdOVkJBTU1ER1JsZGkwMk9URXpNekEwTnpFY01Cb0dDU3FHU0liM0RRRUoKQVJZTmFXNW1iMEJ2YTNSaExtTnZiVEFlRncweU1UQXlNREl4TWpJMk5USmFGdzB6TVRBeU1ESXhNakkzTlRKYU1JR1VNUXN3Q1FZRApWUVFHRXdKVlV6RVRNQkVHQTFVRUNBd0tRMkZzYVdadmNtNXBZVEVXTUJRR0ExVUVCd3dOVTJGdUlFWnlZVzVqYVhOamJ6RU5NQXNHCkExVUVDZ3dFVDJ0MFlURVVNQklHQTFVRUN3d0xVMU5QVUhKdmRtbGtaWEl4RlRBVEJnTlZCQU1NREdSbGRpMDJPVEV6TXpBME56RWMKTUJvR0NTcUdTSWIzRFFFSkFSWU5hVzVtYjBCdmEzUmhMbU52YlRDQ0FTSXdEUVlKS29aSWh2Y05BUUVCQlFBRGdnRVBBRENDQVFvQwpnZ0VCQUl6M3ZTaXdWV3I3aVV5S0hNcEFDamxnU0pVS3JsbDVxc1hUbDhjWDVGa2ovT2dBYVdJQldjcGtwZFQ3aUFSU3dxUWhjVFlOCmZIU3NPa25UY09EMXVoMXlqTTV5Y0NReDBVTy9uMDYrYXBQMUdhaEROZkxGZmJ0MktMQzFGdmNtTXF6OEFVQi9FRVh2eFZTa24wb1UKS0lZWWU5akJMR0loNmZRVWRLZmxqU3Y2VXgvUlV0VEtSaG9PU3hPbkxyWDhIUDdmSEFqU1pmUFY4T0RvbXVWQXVlT3dpdGFZRWYrUQpSQm14QzNveXg5Yk1qZk91c1dVcmxWZUx3T3JPaDRDSkJaWnJ4UmpBUnA1cDBqZXhJaDQwNUE0Y1MzbStSNWNQKzlqVzZHVm5oaUVvCnJKWk9uMWQ4T3VaMW5Ddkk5RlpQc2Y1bmdkd3BLVzBUK3pDdVFNcTgwdGtDQXdFQUFUQU5CZ2txaGtpRzl3MEJBUXNGQUFPQ0FRRUEKVm5uUlYwVmhCa2NjYU8xMm9wRHhOQlJ0V1ZTUGtiNTJuTVdEYVhWRTVKMkgwZ25MKzlackZubE5NbVJJZXFrU2VHRkc2aHZiV3hySQpjVzdRU3NURG1NZld5eEZqZWY1LzlxSEdoTENJbUZMQmtyYVcrT3habUMyOWZ0T29jSkF6WEFHd0phZGFxckRuMzhCbGd6d0pTRFJlCjF4Z2hYUk5iWWFlanlHbUNvTnVyaVZYYk5KRmhvRlU5SnNYZVZDdzFnWjlIWFA5OFVkMDZjL016cmNobHdNcFNMWnB1NkhndHVsTE4KT1RIK3pha3BtajNuVm5jVm9JOHI0OWZjam9TMDgxMXZmQzNlLzR5TStUeDBuM0J6NlJhQ25yK3Iwa0cwTzJkMHJ6TFlXYnJ6SUFjRQp1NHk3WUlpNnltNXQ4VllqWWxzTWFyVDBPUVlwcHArNld0aUYzZz09PC9kczpYNTA5Q2VydGlmaWNhdGU+PC9kczpYNTA5RGF0YT48L2RzOktleUluZm8+PC9kczpTaWduYXR1cmU+PHNhbWwyOlN1YmplY3QgeG1sbnM6c2FtbDI9InVybjpvYXNpczpuYW1lczp0YzpTQU1MOjIuMDphc3NlcnRpb24iPjxzYW1sMjpOYW1lSUQgRm9ybWF0PSJ1cm46b2FzaXM6bmFtZXM6dGM6U0FNTDoxLjE6bmFtZWlkLWZvcm1hdDp1bnNwZWNpZmllZCI+cmVkPC9zYW1sMjpOYW1lSUQ+PHNhbWwyOlN1YmplY3RDb25maXJtYXRpb24gTWV0aG9kPSJ1cm46b2FzaXM6bmFtZXM6dGM6U0FNTDoyLjA6Y206YmVhcmVyIj48c2FtbDI6U3ViamVjdENvbmZpcm1hdGlvbkRhdGEgSW5SZXNwb25zZVRvPSJPTkVMT0dJTl9hODZjNjgwYjE2ZTNjZmVmOWY2NjA2MjIxMGJkYjAzMDM0OTA2OTY5IiBOb3RPbk9yQWZ0ZXI9IjIwMjEtMDQtMTlUMTU6MTY6NDguNDk3WiIgUmVjaXBpZW50PSJodHRwOi8vbG9jYWxob3N0Ojg4ODgvc2FtbCIvPjwvc2FtbDI6U3ViamVjdENvbmZpcm1hdGlvbj48L3NhbWwyOlN1YmplY3Q+PHNhbWwyOkNvbmRpdGlvbnMgTm90QmVmb3JlPSIyMDIxLTA0LTE5VDE1OjA2OjQ4LjQ5N1oiIE5vdE9uT3JBZnRlcj0iMjAyMS0wNC0xOVQxNToxNjo0OC40OTdaIiB4bWxuczpzYW1sMj0idXJuOm9hc2lzOm5hbWVzOnRjOlNBTUw6Mi4wOmFzc2VydGlvbiI+PHNhbWwyOkF1ZGllbmNlUmVzdHJpY3Rpb24+PHNhbWwyOkF1ZGllbmNlPmh0dHA6Ly9sb2NhbGhvc3Q6ODg4ODwvc2FtbDI6QXVkaWVuY2U+PC9zYW1sMjpBdWRpZW5jZVJlc3RyaWN0aW9uPjwvc2FtbDI6Q29uZGl0aW9ucz48c2FtbDI6QXV0aG5TdGF0ZW1lbnQgQXV0aG5JbnN0YW50PSIyMDIxLTA0LTE5VDE1OjExOjQ4LjQ5N1oiIFNlc3Npb25JbmRleD0iT05FTE9HSU5fYTg2YzY4MGIxNmUzY2ZlZjlmNjYwNjIyMTBiZGIwMzAzNDkwNjk2OSIgeG1sbnM6c2FtbDI9InVybjpvYXNpczpuYW1lczp0YzpTQU1MOjIuMDphc3NlcnRpb24iPjxzYW1sMjpBdXRobkNvbnRleHQ+PHNhbWwyOkF1dGhuQ29udGV4dENsYXNzUmVmPnVybjpvYXNpczpuYW1lczp0YzpTQU1MOjIuMDphYzpjbGFzc2VzOlBhc3N3b3JkUHJvdGVjdGVkVHJhbnNwb3J0PC9zYW1sMjpBdXRobkNvbnRleHRDbGFzc1JlZj48L3NhbWwyOkF1dGhuQ29udGV4dD48L3NhbWwyOkF1dGhuU3RhdGVtZW50PjxzYW1sMjpBdHRyaWJ1dGVTdGF0ZW1lbnQgeG1sbnM6c2FtbDI9InVybjpvYXNpczpuYW1lczp0YzpTQU1MOjIuMDphc3NlcnRpb24iPjxzYW1sMjpBdHRyaWJ1dGUgTmFtZT0idXNlcm5hbWUiIE5hbWVGb3JtYXQ9InVybjpvYXNpczpuYW1lczp0YzpTQU1MOjIuMDphdHRybmFtZS1mb3JtYXQ6dW5zcGVjaWZpZWQiPjxzYW1sMjpBdHRyaWJ1dGVWYWx1ZSB4bWxuczp4cz0iaHR0cDovL3d3dy53My5vcmcvMjAwMS9YTUxTY2hlbWEiIHhtbG5zOnhzaT0iaHR0cDovL3d3dy53My5vcmcvMjAwMS9YTUxTY2hlbWEtaW5zdGFuY2UiIHhzaTp0eXBlPSJ4czpzdHJpbmciPnRlc3R1c2VyQGNhbGRlcmEuY2FsZGVyYTwvc2FtbDI6QXR0cmlidXRlVmFsdWU+PC9zYW1sMjpBdHRyaWJ1dGU+PC9zYW1sMjpBdHRyaWJ1dGVTdGF0ZW1lbnQ+PC9zYW1sMjpBc3NlcnRpb24+PC9zYW1sMnA6UmVzcG9uc2U+'
@@ -99,6 +126,20 @@ def saml_settings():
     }
 
 
+@pytest.fixture(scope='module')
+def mock_idp():
+    return MockIdentityProvider()
+
+
+@pytest.fixture
+def tenant_saml_settings(saml_settings):
+    tenant_settings = copy.deepcopy(saml_settings)
+    tenant_settings['idp']['entityId'] = 'http://tenant.example.com/'
+    tenant_settings['idp']['singleSignOnService']['url'] = 'http://tenant.example.com/SSOService.php'
+    tenant_settings['hosts'] = ['tenant.caldera.example.com']
+    return tenant_settings
+
+
 @pytest.fixture
 async def setup_saml(saml_settings):
     login_handler = SamlLoginHandler(BaseService.get_services())
@@ -107,7 +148,7 @@ async def setup_saml(saml_settings):
         login_handler
     )
     saml_svc = BaseService.get_service('saml_svc')
-    saml_svc._saml_config = saml_settings
+    await saml_svc.apply_saml_config(saml_settings)
 
 
 async def test_saml_redirect(aiohttp_client, setup_saml):
@@ -116,6 +157,13 @@ async def test_saml_redirect(aiohttp_client, setup_saml):
     assert resp.headers.get('Location').startswith('http://idp.example.com/SSOService.php?SAMLRequest=')
 
 
+async def test_saml_redirect_to_selected_idp(aiohttp_client, setup_saml, tenant_saml_settings):
+    await BaseService.get_service('saml_svc').apply_saml_config(tenant_saml_settings, idp_name='tenant')
+    resp = await aiohttp_client.post('/?idp=tenant', allow_redirects=False)
+    assert resp.status == HTTPStatus.FOUND
+    assert resp.headers.get('Location').startswith('http://tenant.example.com/SSOService.php?SAMLRequest=')
+
+
 async def test_valid_saml_login(aiohttp_client, setup_saml, generate_saml_post_data):
     resp = await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(VALID_RESPONSE_B64))
     assert resp.status == HTTPStatus.FOUND
@@ -123,6 +171,78 @@ async def test_valid_saml_login(aiohttp_client, setup_saml, generate_saml_post_d
     assert 'API_SESSION' in resp.cookies
 
 
+async def test_fresh_strict_saml_login(aiohttp_client, setup_saml, mock_idp, generate_saml_post_data):
+    base_url = str(aiohttp_client.make_url('')).rstrip('/')
+    await BaseService.get_service('saml_svc').apply_saml_config(mock_idp.sp_settings(base_url, strict=True))
+    saml_response = mock_idp.mint_response(base_url, 'red', generate_attributes(attribute_count=5, attribute_size=32))
+    resp = await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(saml_response))
+    assert resp.status == HTTPStatus.FOUND
+    assert resp.headers.get('Location') == '/'
+    assert 'API_SESSION' in resp.cookies
+
+
+async def test_saml_login_in_response_to_pooled_request(aiohttp_client, setup_saml, mock_idp, generate_saml_post_data):
+    base_url = str(aiohttp_client.make_url('')).rstrip('/')
+    await BaseService.get_service('saml_svc').apply_saml_config(mock_idp.sp_settings(base_url, strict=True))
+    redirect = await aiohttp_client.post('/', allow_redirects=False)
+    request_id = _get_authn_request_id(redirect.headers.get('Location'))
+    saml_response = mock_idp.mint_response(base_url, 'red', generate_attributes(attribute_count=1, attribute_size=8),
+                                           in_response_to=request_id)
+    resp = await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(saml_response))
+    assert resp.status == HTTPStatus.FOUND
+    assert resp.headers.get('Location') == '/'
+
+
+async def test_forged_saml_login_keeps_issued_request(aiohttp_client, setup_saml, mock_idp, generate_saml_post_data,
+                                                      monkeypatch):
+    saml_svc = BaseService.get_service('saml_svc')
+    base_url = str(aiohttp_client.make_url('')).rstrip('/')
+    await saml_svc.apply_saml_config(mock_idp.sp_settings(base_url, strict=True))
+    monkeypatch.setattr(saml_svc, '_require_known_request', True)
+    redirect = await aiohttp_client.post('/', allow_redirects=False)
+    request_id = _get_authn_request_id(redirect.headers.get('Location'))
+    attributes = generate_attributes(attribute_count=1, attribute_size=8)
+    saml_response = base64.b64decode(mock_idp.mint_response(base_url, 'red', attributes, in_response_to=request_id))
+    forged_response = base64.b64encode(saml_response.replace(b'>red<', b'>admin<')).decode('ascii')
+    resp = await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(forged_response))
+    assert resp.headers.get('Location') == '/login'
+    saml_response = mock_idp.mint_response(base_url, 'red', attributes, in_response_to=request_id)
+    resp = await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(saml_response))
+    assert resp.headers.get('Location') == '/'
+    aiohttp_client.session.cookie_jar.clear()
+    saml_response = mock_idp.mint_response(base_url, 'red', attributes, in_response_to=request_id)
+    resp = await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(saml_response))
+    assert resp.headers.get('Location') == '/login'
+
+
+async def test_saml_metrics_endpoint(aiohttp_client, setup_saml, generate_saml_post_data):
+    await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(VALID_RESPONSE_B64))
+    resp = await aiohttp_client.get('/plugin/saml/metrics')
+    assert resp.status == HTTPStatus.OK
+    metrics = await resp.text()
+    assert 'saml_login_outcomes_total{outcome="success"} 1' in metrics
+    assert 'saml_stage_duration_seconds_count{stage="process_response"} 1' in metrics
+
+
+async def test_saml_metrics_endpoint_requires_authorization(aiohttp_client, setup_saml):
+    resp = await aiohttp_client.get('/plugin/saml/metrics', allow_redirects=False)
+    assert resp.status != HTTPStatus.OK
+    resp = await aiohttp_client.get('/plugin/saml/metrics', headers=dict(KEY=BaseService.get_config('api_key_red')))
+    assert resp.status == HTTPStatus.OK
+    assert 'saml_login_outcomes_total' in await resp.text()
+
+
+async def test_saml_metrics_count_failed_login_once(aiohttp_client, setup_saml, generate_saml_post_data, monkeypatch):
+    async def fail_login(request, username):
+        raise Exception('Session store unavailable')
+
+    monkeypatch.setattr(BaseService.get_service('auth_svc'), 'handle_successful_login', fail_login)
+    await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(VALID_RESPONSE_B64))
+    metrics = BaseService.get_service('saml_svc').metrics
+    assert metrics.outcomes['success'] == 0
+    assert metrics.outcomes['error'] == 1
+
+
 async def test_default_login_page(aiohttp_client, setup_saml):
     resp = await aiohttp_client.get('/login', allow_redirects=False)
     assert resp.status == HTTPStatus.UNAUTHORIZED
@@ -136,6 +256,24 @@ async def test_explicit_login_creds(aiohttp_client, setup_saml):
     assert 'API_SESSION' in resp.cookies
 
 
+async def test_reject_replayed_saml_login(aiohttp_client, setup_saml, generate_saml_post_data):
+    resp = await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(VALID_RESPONSE_B64))
+    assert 'API_SESSION' in resp.cookies
+    aiohttp_client.session.cookie_jar.clear()
+    resp = await aiohttp_client.post('/saml', allow_redirects=False, data=generate_saml_post_data(VALID_RESPONSE_B64))
+    assert resp.status == HTTPStatus.FOUND
+    assert resp.headers.get('Location') == '/login'
+    assert 'API_SESSION' not in resp.cookies
+
+
+async def test_reject_oversized_saml_login(aiohttp_client, setup_saml, generate_saml_post_data):
+    resp = await aiohttp_client.post('/saml', allow_redirects=False,
+                                     data=generate_saml_post_data(VALID_RESPONSE_B64 * 64))
+    assert resp.status == HTTPStatus.FOUND
+    assert resp.headers.get('Location') == '/login'
+    assert 'API_SESSION' not in resp.cookies
+
+
 async def test_reject_unsigned_saml_login(aiohttp_client, setup_saml, generate_saml_post_data):
     resp = await aiohttp_client.post('/saml', allow_redirects=False,
                                      data=generate_saml_post_data(UNSIGNED_RESPONSE_B64))
@@ -150,3 +288,357 @@ async def test_reject_saml_login_unknown_application_user(aiohttp_client, setup_
     assert resp.status == HTTPStatus.FOUND
     assert resp.headers.get('Location') == '/login'
     assert 'API_SESSION' not in resp.cookies
+
+
+async def test_sqlite_replay_cache_waits_off_event_loop(aiohttp_client, setup_saml, tmp_path, monkeypatch):
+    saml_svc = BaseService.get_service('saml_svc')
+    replay_cache_path = str(tmp_path / 'replay.db')
+    monkeypatch.setattr(saml_svc, '_replay_cache', create_replay_cache('sqlite', replay_cache_path))
+    other_server = sqlite3.connect(replay_cache_path, isolation_level=None)
+    other_server.execute('BEGIN IMMEDIATE')
+    record = asyncio.ensure_future(saml_svc._call_replay_cache(saml_svc._replay_cache.record, ['response-1']))
+    await asyncio.sleep(0.1)
+    assert not record.done()
+    other_server.execute('COMMIT')
+    assert await record
+    other_server.close()
+
+
+async def test_first_idp_settings_load_runs_once_off_event_loop(aiohttp_client, setup_saml, saml_settings, tmp_path,
+                                                                monkeypatch):
+    saml_svc = BaseService.get_service('saml_svc')
+    (tmp_path / 'settings.json').write_text(json.dumps(saml_settings))
+    monkeypatch.setattr(saml_svc, 'settings_path', str(tmp_path / 'settings.json'))
+    monkeypatch.setattr(saml_svc, '_idp_registry', None)
+    monkeypatch.setattr(saml_svc, '_idp_registry_load', None)
+    read_idp_settings = saml_svc._read_idp_settings
+    reads = []
+
+    def slow_read_idp_settings():
+        reads.append(time.time())
+        time.sleep(0.2)
+        return read_idp_settings()
+
+    monkeypatch.setattr(saml_svc, '_read_idp_settings', slow_read_idp_settings)
+    ticks = []
+
+    async def tick():
+        while len(ticks) < 5:
+            ticks.append(time.time())
+            await asyncio.sleep(0.01)
+
+    first, second, _ = await asyncio.gather(saml_svc._get_idp_registry(), saml_svc._get_idp_registry(), tick())
+    assert first is second
+    assert first.names == ['default']
+    assert len(reads) == 1
+    assert ticks[-1] - ticks[0] < 0.2
+
+
+async def test_reload_idp_settings_overlaps_rotated_cert(aiohttp_client, setup_saml, saml_settings, mock_idp, tmp_path,
+                                                         monkeypatch):
+    saml_svc = BaseService.get_service('saml_svc')
+    settings_path = tmp_path / 'settings.json'
+    monkeypatch.setattr(saml_svc, 'settings_path', str(settings_path))
+    monkeypatch.setattr(saml_svc, 'idps_dir_path', str(tmp_path / 'idps'))
+    settings_path.write_text(json.dumps(saml_settings))
+    assert await saml_svc.reload_idp_settings() is None
+    previous_snapshot = await saml_svc.get_login_settings()
+    rotated_settings = copy.deepcopy(saml_settings)
+    rotated_settings['idp']['x509cert'] = mock_idp.cert_pem
+    settings_path.write_text(json.dumps(rotated_settings))
+    assert await saml_svc.reload_idp_settings() > time.time()
+    rotated_snapshot = await saml_svc.get_login_settings()
+    assert len(rotated_snapshot.idp_certs) == 2
+    assert previous_snapshot.idp_certs[0] in rotated_snapshot.idp_certs
+    settings_path.write_text('{"idp": ')
+    await saml_svc.reload_idp_settings()
+    assert (await saml_svc.get_login_settings()) is rotated_snapshot
+
+
+async def test_idp_metadata_rotation_ends_cert_overlap(aiohttp_client, setup_saml, mock_idp, tmp_path, monkeypatch):
+    saml_svc = BaseService.get_service('saml_svc')
+    metadata_path = tmp_path / 'metadata.xml'
+    monkeypatch.setattr(saml_svc, 'settings_path', str(tmp_path / 'settings.json'))
+    monkeypatch.setattr(saml_svc, 'idps_dir_path', str(tmp_path / 'idps'))
+    monkeypatch.setattr(saml_svc, 'metadata_cache_dir_path', str(tmp_path / 'metadata_cache'))
+    monkeypatch.setattr(saml_svc, '_cert_overlap', 0.5)
+    await saml_svc._config_watcher.stop()
+    saml_config = mock_idp.sp_settings('http://localhost:8888')
+    del saml_config['idp']
+    (tmp_path / 'settings.json').write_text(json.dumps(dict(saml_config, metadata=str(metadata_path))))
+    metadata_path.write_text(mock_idp.metadata())
+    await saml_svc.reload_idp_settings()
+    await saml_svc._refresh_metadata_sources()
+    previous_cert = (await saml_svc.get_login_settings()).idp_certs[0]
+    metadata_path.write_text(MockIdentityProvider().metadata())
+    await saml_svc._refresh_metadata_sources()
+    assert previous_cert in (await saml_svc.get_login_settings()).idp_certs
+    assert saml_svc._config_watcher.reload_at > time.time()
+    await asyncio.sleep(saml_svc._config_watcher.reload_at - time.time())
+    await saml_svc._refresh_metadata_sources()
+    assert len((await saml_svc.get_login_settings()).idp_certs) == 1
+    assert previous_cert not in (await saml_svc.get_login_settings()).idp_certs
+    assert saml_svc._config_watcher.reload_at is None
+
+
+async def test_idp_metadata_conditional_refresh_and_disk_cache(aiohttp_server, mock_idp, tmp_path):
+    if_none_match_headers = []
+
+    async def serve_metadata(request):
+        if_none_match_headers.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=HTTPStatus.NOT_MODIFIED)
+        return web.Response(text=mock_idp.metadata(), content_type='application/samlmetadata+xml', headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_route('GET', '/metadata', serve_metadata)
+    server = await aiohttp_server(app)
+    location = str(server.make_url('/metadata'))
+    cache_path = str(tmp_path / 'metadata_cache' / 'default.json')
+    loop = asyncio.get_event_loop()
+    metadata_source = IdpMetadataSource(location, cache_path, allow_http=True)
+    assert await loop.run_in_executor(None, metadata_source.refresh)
+    assert not await loop.run_in_executor(None, metadata_source.refresh)
+    assert if_none_match_headers == [None, '"v1"']
+    assert metadata_source.next_refresh > time.time()
+    cached_source = IdpMetadataSource(location, cache_path, allow_http=True)
+    assert cached_source.metadata == metadata_source.metadata
+    saml_config = mock_idp.sp_settings('http://localhost:8888')
+    del saml_config['idp']
+    settings_snapshot = SamlSettingsSnapshot(cached_source.merge_into(saml_config))
+    assert settings_snapshot.idp_entity_id == mock_idp.entity_id
+    assert settings_snapshot.settings.get_idp_sso_url() == mock_idp.sso_url
+
+
+def test_idp_metadata_requires_https_and_pinned_cert(mock_idp, tmp_path):
+    with pytest.raises(Exception, match='plain http'):
+        IdpMetadataSource('http://idp.example.com/metadata', str(tmp_path / 'metadata_cache' / 'default.json'))
+    metadata_path = tmp_path / 'metadata.xml'
+    metadata_path.write_text(mock_idp.metadata())
+    cert_der = base64.b64decode(''.join(mock_idp.cert_pem.splitlines()[1:-1]))
+    fingerprint = hashlib.sha256(cert_der).hexdigest()
+    cache_path = str(tmp_path / 'metadata_cache' / 'default.json')
+    pinned_source = IdpMetadataSource(str(metadata_path), cache_path, cert_fingerprint=fingerprint.upper(),
+                                      cert_fingerprint_algorithm='sha256')
+    assert pinned_source.refresh()
+    mismatched_source = IdpMetadataSource(str(metadata_path), cache_path, cert_fingerprint='00' * 32,
+                                          cert_fingerprint_algorithm='sha256')
+    assert mismatched_source.metadata is None
+    with pytest.raises(Exception, match='does not match the pinned certFingerprint'):
+        mismatched_source.refresh()
+
+
+def test_config_watcher_detects_changed_files(tmp_path):
+    settings_path = tmp_path / 'settings.json'
+    settings_path.write_text('{}')
+    watcher = SamlConfigWatcher([str(tmp_path / '*.json')], reload=None)
+    assert not watcher.has_changed()
+    settings_path.write_text('{"strict": true}')
+    assert watcher.has_changed()
+    assert not watcher.has_changed()
+    watcher.reload_at = time.time() - 1
+    assert watcher.has_changed()
+
+
+def test_plugin_import_defers_saml_stack(record_property):
+    import_plugin = (
+        'import json, sys, time\n'
+        'start = time.perf_counter()\n'
+        'import plugins.saml.hook, plugins.saml.app.saml_login_handler, plugins.saml.app.saml_svc\n'
+        'print(json.dumps(dict(seconds=time.perf_counter() - start,\n'
+        '                      modules=[m for m in sys.modules if m.split(".")[0] in ("onelogin", "xmlsec")])))\n'
+    )
+    result = json.loads(subprocess.check_output([sys.executable, '-c', import_plugin], cwd=str(Path(__file__).parents[3])))
+    record_property('plugin_import_seconds', result['seconds'])
+    assert result['modules'] == []
+
+
+def test_verification_result_is_picklable(saml_settings, generate_saml_post_data):
+    request_data = dict(http_host='localhost', script_name='/saml', server_port=8888, get_data={},
+                        post_data=generate_saml_post_data(VALID_RESPONSE_B64))
+    verification = pickle.loads(pickle.dumps(verify_saml_response(request_data, SamlSettingsSnapshot(saml_settings))))
+    assert verification.authenticated
+    assert not verification.errors
+    assert verification.attributes.get('username')
+
+
+def test_warm_up_verifier_checks_a_signature_for_each_sp_key(saml_settings, mock_idp):
+    signing_settings = copy.deepcopy(saml_settings)
+    signing_settings['sp'].update(x509cert=mock_idp.cert_pem, privateKey=mock_idp.private_key_pem)
+    settings_snapshots = [SamlSettingsSnapshot(saml_settings), SamlSettingsSnapshot(signing_settings)]
+    assert warm_up_verifier(settings_snapshots, threading.Barrier(1)) == 1
+    assert warm_up_verifier(pickle.loads(pickle.dumps(settings_snapshots))) == 1
+
+
+def test_verification_result_reports_missing_response(saml_settings):
+    request_data = dict(http_host='localhost', script_name='/saml', server_port=8888, get_data={}, post_data={})
+    verification = verify_saml_response(request_data, SamlSettingsSnapshot(saml_settings))
+    assert not verification.authenticated
+    assert verification.errors == ['invalid_binding']
+
+
+def test_settings_snapshot_precompiles_idp_cert(saml_settings):
+    snapshot = SamlSettingsSnapshot(saml_settings)
+    assert snapshot.idp_entity_id == 'http://idp.example.com/'
+    assert snapshot.idp_certs[0].startswith('-----BEGIN CERTIFICATE-----')
+    assert len(snapshot.idp_keys) == 1
+    assert saml_settings['idp']['x509cert'] == snapshot.config['idp']['x509cert']
+
+
+def test_settings_snapshot_survives_process_boundary(saml_settings):
+    snapshot = SamlSettingsSnapshot(saml_settings)
+    restored = pickle.loads(pickle.dumps(snapshot))
+    assert restored.fingerprint == snapshot.fingerprint
+    assert restored.settings.get_idp_data() == snapshot.settings.get_idp_data()
+    assert pickle.loads(pickle.dumps(snapshot)) is restored
+
+
+def test_prescan_extracts_message_ids():
+    prescan = prescan_saml_response(VALID_RESPONSE_B64)
+    assert prescan.response_id == 'id77276934370865552136108628'
+    assert prescan.assertion_ids == ['id7727693437157228326226364']
+    assert prescan.issuer == 'http://www.okta.com/exkbmdi9avpiwtanV5d6'
+    assert prescan.destination == 'http://localhost:8888/saml'
+    assert prescan.has_signature
+
+
+def test_prescan_detects_unsigned_response():
+    assert not prescan_saml_response(UNSIGNED_RESPONSE_B64).has_signature
+
+
+def test_prescan_rejects_non_saml_payload():
+    with pytest.raises(Exception):
+        prescan_saml_response('bm90IGEgc2FtbCByZXNwb25zZQ==')
+
+
+def test_envelope_check_requires_issuer_only_when_strict(saml_settings):
+    prescan = prescan_saml_response(VALID_RESPONSE_B64)._replace(issuer=None)
+    request_data = dict(http_host='localhost', script_name='/saml', server_port=8888, get_data={})
+    SamlService._check_saml_envelope(prescan, SamlSettingsSnapshot(saml_settings), request_data)
+    strict_settings = dict(saml_settings, strict=True)
+    with pytest.raises(Exception, match='does not contain an Issuer'):
+        SamlService._check_saml_envelope(prescan, SamlSettingsSnapshot(strict_settings), request_data)
+
+
+def test_authn_request_pool_issues_unique_signed_requests(mock_idp):
+    sp_settings = mock_idp.sp_settings('http://localhost:8888')
+    sp_settings['sp'].update(x509cert=mock_idp.cert_pem, privateKey=mock_idp.private_key_pem)
+    sp_settings['security']['authnRequestsSigned'] = True
+    pool = AuthnRequestPool(SamlSettingsSnapshot(sp_settings), pool_size=4)
+    pool.fill()
+    request_data = dict(http_host='localhost', script_name='/', server_port=8888, get_data={})
+    request_ids = set()
+    for _ in range(6):
+        request_id, redirect = pool.build_redirect(request_data)
+        request_ids.add(request_id)
+        query = parse_qs(urlsplit(redirect).query)
+        assert _get_authn_request_id(redirect) == request_id
+        assert query['RelayState'] == ['http://localhost:8888/']
+        assert query['Signature']
+    assert len(request_ids) == 6
+
+
+def test_issued_request_index_consumes_once():
+    issued_requests = IssuedRequestIndex(ttl=60, max_entries=2)
+    for request_id in ('request-1', 'request-2', 'request-3'):
+        issued_requests.add(request_id)
+    assert not issued_requests.contains('request-1')
+    assert issued_requests.contains('request-2')
+    assert not issued_requests.consume('request-1')
+    assert issued_requests.consume('request-2')
+    assert not issued_requests.consume('request-2')
+
+
+@pytest.mark.parametrize('backend_factory', [
+    lambda tmp_path: MemoryReplayBackend(max_entries=2),
+    lambda tmp_path: SqliteReplayBackend(str(tmp_path / 'replay.db'), max_entries=2),
+])
+def test_replay_cache_rejects_duplicates_and_evicts(tmp_path, backend_factory):
+    replay_cache = AssertionReplayCache(backend_factory(tmp_path), min_ttl=60)
+    assert replay_cache.record(['response-1'])
+    assert replay_cache.is_replay(['response-1'])
+    assert not replay_cache.record(['response-1'])
+    assert replay_cache.record(['response-2', 'assertion-2'])
+    assert len(replay_cache.backend) == 2
+    assert not replay_cache.is_replay(['response-1'])
+    replay_cache.backend.add(['expired'], 1, 2)
+    assert not replay_cache.is_replay(['expired'])
+
+
+def test_idp_registry_routes_by_issuer_name_and_host(saml_settings, tenant_saml_settings):
+    tenant_config, plugin_config = split_plugin_settings(tenant_saml_settings)
+    registry = IdpRegistry() \
+        .with_idp('default', SamlSettingsSnapshot(saml_settings)) \
+        .with_idp('tenant', SamlSettingsSnapshot(tenant_config), plugin_config['hosts'])
+    assert registry.for_issuer('http://tenant.example.com/') is registry.get('tenant')
+    assert registry.for_issuer('http://unknown.example.com/') is registry.default is registry.get('default')
+    assert registry.for_login(idp_name='tenant') is registry.get('tenant')
+    assert registry.for_login(host='Tenant.Caldera.example.com') is registry.get('tenant')
+    assert registry.for_login(host='localhost') is registry.default
+
+
+def test_idp_registry_rejects_shared_issuer(saml_settings):
+    registry = IdpRegistry().with_idp('first', SamlSettingsSnapshot(saml_settings))
+    assert registry.default is registry.get('first')
+    with pytest.raises(Exception):
+        registry.with_idp('second', SamlSettingsSnapshot(saml_settings))
+
+
+def test_attribute_mapper_applies_first_matching_rule():
+    attribute_mapper = AttributeMapper([
+        dict(attribute='groups', equals=['caldera-admins', 'soc-leads'], user='admin'),
+        dict(attribute='email', matches=r'.+@red\.example\.com', user='red'),
+        dict(attribute='email', matches=r'.+@(blue|purple)\.example\.com', user='blue'),
+        dict(attribute='department', equals='red-team', user='red'),
+    ] + [dict(attribute='employee_id', equals=str(index), user='blue') for index in range(2000)], cache_size=16)
+    assert attribute_mapper.map(dict(groups=['users', 'soc-leads'], email=['x@blue.example.com'])) == 'admin'
+    assert attribute_mapper.map(dict(email=['x@purple.example.com'], department=['red-team'])) == 'blue'
+    assert attribute_mapper.map(dict(email=['x@red.example.com.evil'], department=['red-team'])) == 'red'
+    assert attribute_mapper.map(dict(employee_id=['1999'], username=['someone'])) == 'blue'
+    assert attribute_mapper.map(dict(employee_id=['1999'], username=['someone else'])) == 'blue'
+    assert attribute_mapper.map(dict(email=['x@example.com'])) is None
+    assert attribute_mapper.cache_info().hits == 1
+    with pytest.raises(Exception):
+        AttributeMapper([dict(attribute='email', matches='(unclosed', user='red')])
+
+
+def test_attribute_mapper_scopes_inline_flags_to_their_rule():
+    mapper = AttributeMapper([
+        {'attribute': 'email', 'matches': r'(?i).+@red\.example\.com', 'user': 'red'},
+        {'attribute': 'email', 'matches': r'.+@BLUE\.example\.com', 'user': 'blue'},
+    ])
+    assert mapper.map({'email': ['Alice@RED.example.com']}) == 'red'
+    assert mapper.map({'email': ['bob@BLUE.example.com']}) == 'blue'
+    assert mapper.map({'email': ['bob@blue.example.com']}) is None
+    with pytest.raises(Exception, match='may only use these inline flags'):
+        AttributeMapper([{'attribute': 'email', 'matches': r'(?a)\w+', 'user': 'red'}])
+    with pytest.raises(Exception, match='invalid pattern'):
+        AttributeMapper([{'attribute': 'email', 'matches': r'.+@red(?i)', 'user': 'red'}])
+
+
+def test_saml_metrics_render_prometheus_histograms():
+    metrics = SamlMetrics(buckets=(0.1, 1.0))
+    metrics.observe('process_response', 0.05)
+    metrics.observe('process_response', 0.5)
+    with metrics.time_stage('user_lookup'):
+        pass
+    metrics.count_outcome('unknown_user')
+    rendered = metrics.render_prometheus()
+    assert 'saml_stage_duration_seconds_bucket{stage="process_response",le="0.1"} 1' in rendered
+    assert 'saml_stage_duration_seconds_bucket{stage="process_response",le="1.0"} 2' in rendered
+    assert 'saml_stage_duration_seconds_bucket{stage="process_response",le="+Inf"} 2' in rendered
+    assert 'saml_stage_duration_seconds_count{stage="user_lookup"} 1' in rendered
+    assert 'saml_login_outcomes_total{outcome="unknown_user"} 1' in rendered
+
+
+def test_load_test_baseline_comparison():
+    baseline = dict(saml_post_c8=summarize([0.010] * 100, elapsed=1.0, lag_samples=[0.001]))
+    assert not compare_with_baseline(dict(saml_post_c8=summarize([0.011] * 100, 1.1, [0.001])), baseline)
+    regressions = compare_with_baseline(dict(saml_post_c8=summarize([0.020] * 100, 2.0, [0.001])), baseline)
+    assert len(regressions) == 2
+
+
+def _get_authn_request_id(redirect):
+    saml_request = parse_qs(urlsplit(redirect).query)['SAMLRequest'][0]
+    authn_request = zlib.decompress(base64.b64decode(saml_request), -15).decode('utf-8')
+    return re.search(r'\sID="([^"]+)"', authn_request).group(1)